@@ -0,0 +1 @@
+from car_market.transformers import CarsTransformer, CarFeaturesTransformer
@@ -0,0 +1,282 @@
+import argparse
+import os
+import time
+from itertools import chain
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from car_market.artifacts import load_vocabularies
+from car_market.dataset import Deduplicator, extract_province, parse_feature_string, prices_in_usd, \
+    publication_dates, read_adverts
+from car_market.figures import load_figure, visualization_path
+from car_market.rates import load_exchange_rates
+from car_market.transformers import CarFeaturesTransformer
+
+
+# One parquet file per publication date, so new adverts only rewrite the days they were published on
+aggregates_path = visualization_path / 'aggregates'
+undated_name = 'undated'
+# Hashes of the counted adverts, appended to by every update
+hashes_name = 'hashes.u64'
+store_columns = ['date', 'chart', 'label', 'count']
+
+
+def range_labels(edges, format_edge=str):
+    labels = [f'< {format_edge(edges[0])}']
+    labels += [f'{format_edge(low)} to {format_edge(high)}' for low, high in zip(edges[:-1], edges[1:])]
+    return labels + [f'> {format_edge(edges[-1])}']
+
+
+price_edges = [1000, 2500, 5000, 10000, 17500, 30000, 50000, 80000, 120000]
+mileage_edges = [100, 2000, 10000, 25000, 50000, 100000, 150000, 200000, 250000, 300000, 400000]
+power_edges = [60, 90, 120, 150, 200, 300, 450]
+displacement_edges = [1000, 1400, 1800, 2000, 3000, 4500]
+# chart name -> (column, bin edges, bin labels); values fall into [edge, next edge)
+histograms = {
+    'car_prices': ('Price_USD', price_edges, range_labels(price_edges, lambda edge: f'{edge / 1000:g}k')),
+    'production_years': ('Production_year', list(range(2000, 2023)),
+                         ['older'] + [str(year) for year in range(2000, 2023)]),
+    'mileage': ('Mileage_km', mileage_edges, range_labels(mileage_edges)),
+    'horsepowers': ('Power_HP', power_edges, range_labels(power_edges)),
+    'displacements': ('Displacement_cm3', displacement_edges,
+                      range_labels(displacement_edges, lambda edge: f'{edge / 1000:.1f}')),
+}
+# chart name -> (column, number of most frequent values shown next to an 'other' bar with the rest, or None for all)
+categories = {
+    'car_brands': ('Vehicle_brand', 25),
+    'car_models': ('Vehicle_model', 25),
+    'model_generations': ('Model_generation', 25),
+    'provinces': ('Province', None),
+    'cars_features': ('Feature', 25),
+    'car_conditions': ('Condition', None),
+    'car_transmissions': ('Transmission', None),
+    'car_drives': ('Drive', None),
+    'car_types': ('Type', None),
+    'car_fuel_types': ('Fuel_type', None),
+}
+raw_columns = ['Price', 'Currency', 'Condition', 'Vehicle_brand', 'Vehicle_model', 'Vehicle_generation',
+               'Production_year', 'Mileage_km', 'Power_HP', 'Displacement_cm3', 'Fuel_type', 'Drive', 'Transmission',
+               'Type', 'Offer_publication_date', 'Offer_location', 'Features']
+# Log-spaced price buckets with 1% relative accuracy; bucket counts can be summed across days like the histograms
+sketch_accuracy = 0.01
+sketch_gamma = (1 + sketch_accuracy) / (1 - sketch_accuracy)
+
+
+def prepare_adverts(adverts, exchange_rates, provinces):
+    return adverts.assign(Price_USD=prices_in_usd(adverts, exchange_rates),
+                          Province=extract_province(adverts['Offer_location'], provinces),
+                          Model_generation='(' + adverts['Vehicle_model'] + ') ' + adverts['Vehicle_generation'],
+                          date=publication_dates(adverts))
+
+
+def count_labels(dates, chart, labels):
+    frame = pd.DataFrame({'date': dates, 'label': labels}).dropna(subset=['label'])
+    counts = frame.groupby(['date', 'label'], dropna=False).size().reset_index(name='count')
+    return counts.assign(chart=chart)[store_columns]
+
+
+def count_features(dates, features):
+    # Identical feature lists are common, so each distinct string is parsed once
+    list_counts = pd.DataFrame({'date': dates, 'features': features}).groupby(
+        ['date', 'features'], dropna=False).size().reset_index(name='count')
+    parsed = {value: parse_feature_string(value) for value in list_counts['features'].unique()}
+    lengths = list_counts['features'].map(lambda value: len(parsed[value])).to_numpy(dtype=np.int64)
+    counts = pd.DataFrame({'date': np.repeat(list_counts['date'].to_numpy(), lengths),
+                           'label': list(chain.from_iterable(parsed[value] for value in list_counts['features'])),
+                           'count': np.repeat(list_counts['count'].to_numpy(), lengths)})
+    counts['label'] = counts['label'].map(CarFeaturesTransformer.normalize_feature)
+    counts = counts.groupby(['date', 'label'], dropna=False)['count'].sum().reset_index()
+    return counts.assign(chart='cars_features')[store_columns]
+
+
+def aggregate_adverts(adverts):
+    dates = adverts['date'].to_numpy()
+    partials = [count_labels(dates, 'adverts', np.full(len(adverts), 'all', dtype=object))]
+
+    for name, (col, edges, labels) in histograms.items():
+        values = adverts[col].to_numpy()
+        bins = np.searchsorted(edges, values, side='right')
+        binned = np.where(np.isnan(values), None, np.array(labels, dtype=object)[bins])
+        partials.append(count_labels(dates, name, binned))
+
+    for name, (col, _) in categories.items():
+        if col == 'Feature':
+            partials.append(count_features(dates, adverts['Features'].to_numpy()))
+        else:
+            partials.append(count_labels(dates, name, adverts[col].to_numpy()))
+
+    prices = adverts['Price_USD'].to_numpy()
+    buckets = np.ceil(np.log(prices, where=prices > 0, out=np.full(len(prices), np.nan)) / np.log(sketch_gamma))
+    partials.append(count_labels(dates, 'price_sketch', pd.Series(buckets).map(
+        lambda bucket: None if np.isnan(bucket) else str(int(bucket))).to_numpy()))
+    return merge_counts(partials)
+
+
+def merge_counts(frames):
+    frame = pd.concat(frames, ignore_index=True)
+    counts = frame.groupby(['date', 'chart', 'label'], dropna=False, sort=False)['count'].sum()
+    return counts.reset_index()[store_columns]
+
+
+def empty_store():
+    return pd.DataFrame({'date': pd.Series(dtype='datetime64[ns]'), 'chart': pd.Series(dtype=object),
+                         'label': pd.Series(dtype=object), 'count': pd.Series(dtype=np.int64)})
+
+
+def day_path(path, date):
+    return Path(path) / f'{undated_name if pd.isna(date) else f"{date:%Y-%m-%d}"}.parquet'
+
+
+def day_paths(path, start=None, end=None):
+    # File names are ISO dates, so a date range is a range of names
+    paths = sorted(Path(path).glob('*.parquet'))
+    if start is None and end is None:
+        return paths
+    start = '0000' if start is None else pd.Timestamp(start).strftime('%Y-%m-%d')
+    end = '9999' if end is None else pd.Timestamp(end).strftime('%Y-%m-%d')
+    return [day for day in paths if day.stem != undated_name and start <= day.stem <= end]
+
+
+def load_hashes(path=aggregates_path):
+    hashes = Path(path) / hashes_name
+    return np.sort(np.fromfile(hashes, dtype=np.uint64)) if hashes.exists() else None
+
+
+def update_aggregates(input_path, path=aggregates_path, chunk_size=50000, rebuild=False):
+    path = Path(path)
+    if rebuild:
+        for day in day_paths(path):
+            day.unlink()
+        (path / hashes_name).unlink(missing_ok=True)
+    path.mkdir(parents=True, exist_ok=True)
+    deduplicate = Deduplicator(load_hashes(path))
+    exchange_rates = load_exchange_rates()
+    provinces = list(load_vocabularies()['Offer_location'])
+
+    partials = [aggregate_adverts(prepare_adverts(deduplicate(chunk), exchange_rates, provinces))
+                for chunk in read_adverts(input_path, chunk_size, columns=raw_columns)]
+    delta = merge_counts(partials) if partials else empty_store()
+
+    # Only the files of the days present in the delta are read and written again
+    for date, counts in delta.groupby('date', dropna=False, sort=False):
+        day = day_path(path, date)
+        if day.exists():
+            counts = merge_counts([load_day(day), counts])
+        save_day(counts.sort_values('chart', kind='stable'), day)
+    with open(path / hashes_name, 'ab') as file:
+        deduplicate.added_hashes().tofile(file)
+    return delta
+
+
+def save_day(counts, path):
+    # Written under a temporary name first, so an interrupted update leaves the previous file intact
+    partial = path.with_suffix('.partial')
+    pq.write_table(pa.Table.from_pandas(counts[store_columns], preserve_index=False), partial)
+    os.replace(partial, path)
+
+
+def load_day(path):
+    return pq.read_table(path).to_pandas()
+
+
+def load_aggregates(path=aggregates_path, start=None, end=None):
+    days = day_paths(path, start, end)
+    if not days:
+        return empty_store()
+    return pd.concat([load_day(day) for day in days], ignore_index=True)
+
+
+def select_dates(store, start=None, end=None):
+    if start is not None:
+        store = store[store['date'] >= pd.Timestamp(start)]
+    if end is not None:
+        store = store[store['date'] <= pd.Timestamp(end)]
+    return store
+
+
+def query_aggregates(store, start=None, end=None):
+    store = select_dates(store, start, end)
+    return store.groupby(['chart', 'label'], as_index=False)['count'].sum()
+
+
+def price_quantiles(counts, quantiles=(0.1, 0.25, 0.5, 0.75, 0.9)):
+    sketch = counts[counts['chart'] == 'price_sketch']
+    buckets = sketch['label'].astype(int).to_numpy()
+    order = np.argsort(buckets)
+    buckets, cumulative = buckets[order], np.cumsum(sketch['count'].to_numpy()[order])
+    if not len(cumulative):
+        return {quantile: None for quantile in quantiles}
+    positions = np.searchsorted(cumulative, np.asarray(quantiles) * cumulative[-1], side='left')
+    values = 2 * sketch_gamma ** buckets[positions.clip(max=len(buckets) - 1)] / (sketch_gamma + 1)
+    return dict(zip(quantiles, values.tolist()))
+
+
+def summarize(store, start=None, end=None):
+    store = select_dates(store, start, end)
+    dates = store['date'].dropna()
+    return {'adverts': int(store.loc[store['chart'] == 'adverts', 'count'].sum()),
+            'first_date': dates.min().date().isoformat() if len(dates) else None,
+            'last_date': dates.max().date().isoformat() if len(dates) else None}
+
+
+def market_figure(name, counts):
+    figure = load_figure(name)
+    counts = counts[counts['chart'] == name]
+    trace = figure['data'][0]
+    if name in categories and trace['type'] == 'pie':
+        counts = counts.sort_values('label')
+    elif name in categories:
+        top = categories[name][1]
+        counts = counts.sort_values(['count', 'label'], ascending=[False, True])
+        if top is not None and len(counts) > top:
+            other = pd.DataFrame({'label': ['other'], 'count': [counts['count'].iloc[top:].sum()]})
+            counts = pd.concat([counts.head(top), other], ignore_index=True)
+    else:
+        # Bins without any adverts in the selected dates are absent from the store
+        labels = histograms[name][2]
+        counts = counts.set_index('label')['count'].reindex(labels, fill_value=0).rename_axis('label').reset_index()
+    labels, values = counts['label'].tolist(), counts['count'].tolist()
+
+    if trace['type'] == 'pie':
+        trace.update(labels=labels, values=values)
+    elif trace.get('orientation') == 'h':
+        trace.update(x=values, y=labels)
+    else:
+        trace.update(x=labels, y=values)
+    figure['data'] = [trace]
+    return figure
+
+
+def load_market_summary(path=aggregates_path):
+    if day_paths(path):
+        return summarize(load_aggregates(path))
+    return {'adverts': 208304, 'first_date': '2021-03-26', 'last_date': '2021-05-05'}
+
+
+def load_market_figure(name, path=aggregates_path, start=None, end=None):
+    if day_paths(path):
+        return market_figure(name, query_aggregates(load_aggregates(path, start, end), start, end))
+    return load_figure(name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compute or update the market chart aggregates from advert CSVs.')
+    parser.add_argument('input', help='advert CSV in the layout of Car_sale_ads.csv from the Kaggle dataset')
+    parser.add_argument('--output', default=aggregates_path, help='folder of daily aggregate files to write or update')
+    parser.add_argument('--rebuild', action='store_true', help='replace the aggregates instead of adding to them')
+    parser.add_argument('--chunk-size', type=int, default=50000, help='number of adverts read at once')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    delta = update_aggregates(args.input, args.output, args.chunk_size, args.rebuild)
+    added = int(delta.loc[delta['chart'] == 'adverts', 'count'].sum())
+    print(f'Added {added:,} new adverts in {time.perf_counter() - start:.2f} s')
+
+    summary = summarize(load_aggregates(args.output))
+    print(f'{summary["adverts"]:,} adverts from {summary["first_date"]} to {summary["last_date"]} in total')
+
+
+if __name__ == '__main__':
+    main()
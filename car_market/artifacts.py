@@ -0,0 +1,132 @@
+import functools
+import hashlib
+import io
+import json
+import pickle
+import zipfile
+from pathlib import Path
+from xgboost.sklearn import XGBRegressor
+from car_market import transformers
+
+
+data_path = Path(__file__).parents[1] / 'web_app_data'
+bundle_name = 'model_bundle.zip'
+bundle_format_version = 1
+vocabulary_names = ['Colour', 'Condition', 'Drive', 'Features', 'Fuel_type', 'Offer_location', 'Transmission', 'Type',
+                    'Vehicle_brand', 'Vehicle_model']
+
+
+class ArtifactUnpickler(pickle.Unpickler):
+    # preprocessor.pkl was pickled from a script run as __main__, so its transformers are looked up there
+    def find_class(self, module, name):
+        if module == '__main__' and hasattr(transformers, name):
+            return getattr(transformers, name)
+        return super().find_class(module, name)
+
+
+class RestrictedUnpickler(ArtifactUnpickler):
+    # Exactly the classes of the fitted pipeline and the NumPy arrays in it, any other global (even a pandas or
+    # scikit-learn function) is refused, as a pickle can call whatever it is allowed to load
+    allowed_classes = {
+        ('car_market.transformers', 'CarsTransformer'), ('car_market.transformers', 'CarFeaturesTransformer'),
+        ('__main__', 'CarsTransformer'), ('__main__', 'CarFeaturesTransformer'),
+        ('sklearn.pipeline', 'Pipeline'),
+        ('sklearn.compose._column_transformer', 'ColumnTransformer'),
+        ('sklearn.preprocessing._encoders', 'OneHotEncoder'),
+        ('sklearn.preprocessing._data', 'StandardScaler'), ('sklearn.preprocessing.data', 'StandardScaler'),
+        ('sklearn.impute._base', 'SimpleImputer'), ('sklearn.impute', 'SimpleImputer'),
+        # remainder='passthrough' of the ColumnTransformer, its func is None
+        ('sklearn.preprocessing._function_transformer', 'FunctionTransformer'),
+        ('numpy', 'ndarray'), ('numpy', 'dtype'),
+        ('numpy.core.multiarray', '_reconstruct'), ('numpy._core.multiarray', '_reconstruct'),
+        ('numpy.core.multiarray', 'scalar'), ('numpy._core.multiarray', 'scalar'),
+        # Protocol 5 rebuilds numeric arrays from their raw buffers
+        ('numpy.core.numeric', '_frombuffer'), ('numpy._core.numeric', '_frombuffer'),
+        ('numpy', 'float64'), ('numpy', 'float32'), ('numpy', 'int64'), ('numpy', 'int32'), ('numpy', 'uint8'),
+        ('numpy', 'bool_'), ('numpy', 'object_'), ('numpy', 'str_'),
+        ('collections', 'OrderedDict'), ('copyreg', '_reconstructor'), ('_codecs', 'encode')}
+    allowed_builtins = {'dict', 'list', 'tuple', 'set', 'frozenset', 'slice', 'range', 'object', 'bool', 'int', 'float',
+                        'complex', 'str', 'bytes', 'bytearray'}
+
+    def find_class(self, module, name):
+        if module == 'builtins' and name in self.allowed_builtins or (module, name) in self.allowed_classes:
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError(f'{module}.{name} is not allowed in a model bundle')
+
+
+class Bundle:
+
+    def __init__(self, data):
+        self.digest = hashlib.sha256(data).hexdigest()
+        self.archive = zipfile.ZipFile(io.BytesIO(data))
+        self.manifest = json.loads(self.archive.read('manifest.json'))
+        if self.manifest['format_version'] != bundle_format_version:
+            raise ValueError(f'Unsupported model bundle format version: {self.manifest["format_version"]}')
+
+    def load_vocabularies(self):
+        return json.loads(self.archive.read('vocabularies.json').decode('utf-8'))
+
+    def load_preprocessor(self):
+        return RestrictedUnpickler(io.BytesIO(self.archive.read('preprocessor.pkl'))).load()
+
+    def load_model(self):
+        regressor = XGBRegressor()
+        regressor.load_model(bytearray(self.archive.read('model.json')))
+        return regressor
+
+
+@functools.lru_cache(maxsize=4)
+def open_bundle(path, modified_ns=None):
+    return Bundle(Path(path).read_bytes())
+
+
+def find_bundle(folder_path):
+    path = Path(folder_path) / bundle_name
+    return open_bundle(path.resolve(), path.stat().st_mtime_ns) if path.exists() else None
+
+
+def artifact_files(folder_path=data_path):
+    bundle_path = Path(folder_path) / bundle_name
+    if bundle_path.exists():
+        return [bundle_path]
+    return [Path(folder_path) / 'preprocessor.pkl', Path(folder_path) / 'simplified_model.pkl']
+
+
+def artifact_stamp(folder_path=data_path):
+    return tuple((path.name, path.stat().st_mtime_ns, path.stat().st_size) for path in artifact_files(folder_path))
+
+
+def artifact_hash(folder_path=data_path):
+    bundle = find_bundle(folder_path)
+    if bundle is not None:
+        return bundle.digest
+    digest = hashlib.sha256()
+    for path in artifact_files(folder_path):
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def load_pickle(path):
+    with open(path, 'rb') as file:
+        return ArtifactUnpickler(file).load()
+
+
+def load_model(folder_path=data_path):
+    bundle = find_bundle(folder_path)
+    if bundle is not None:
+        return bundle.load_model()
+    return load_pickle(Path(folder_path) / 'simplified_model.pkl')
+
+
+def load_preprocessor(folder_path=data_path):
+    bundle = find_bundle(folder_path)
+    if bundle is not None:
+        return bundle.load_preprocessor()
+    return load_pickle(Path(folder_path) / 'preprocessor.pkl')
+
+
+def load_vocabularies(folder_path=data_path):
+    bundle = find_bundle(folder_path)
+    if bundle is not None:
+        return bundle.load_vocabularies()
+    return {name: load_pickle(Path(folder_path) / f'{name}.pkl') for name in vocabulary_names}
@@ -0,0 +1,108 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from car_market.artifacts import data_path, load_vocabularies
+from car_market.normalization import Normalizer
+from car_market.predictor import get_predictor
+from car_market.rates import load_exchange_rates
+from car_market.schema import prepare_input
+
+
+def read_chunks(input_path, chunk_size):
+    input_path = Path(input_path)
+    if input_path.suffix == '.parquet':
+        parquet_file = pq.ParquetFile(input_path)
+        for batch in parquet_file.iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(input_path, chunksize=chunk_size)
+
+
+class ChunkWriter:
+
+    def __init__(self, output_path):
+        self.output_path = Path(output_path)
+        self.parquet_writer = None
+        self.rows_written = 0
+
+    def write(self, chunk):
+        if self.output_path.suffix == '.parquet':
+            if self.parquet_writer is None:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                self.parquet_writer = pq.ParquetWriter(self.output_path, table.schema)
+            else:
+                table = pa.Table.from_pandas(chunk, schema=self.parquet_writer.schema, preserve_index=False)
+            self.parquet_writer.write_table(table)
+        else:
+            first_chunk = self.rows_written == 0
+            chunk.to_csv(self.output_path, mode='w' if first_chunk else 'a', header=first_chunk, index=False)
+        self.rows_written += len(chunk)
+
+    def close(self):
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+
+def get_exchange_rate():
+    return load_exchange_rates().rate('USD', 'PLN')
+
+
+def predict_prices(data, predictor, USD_to_PLN, vocabularies=None, normalizer=None):
+    # The written rows keep the values as given, only the model sees the normalized ones
+    X = prepare_input(data if normalizer is None else normalizer.normalize(data), vocabularies,
+                      None if vocabularies is None else predictor.load().preprocessor)
+    price_USD = predictor.predict(X)
+    return data.assign(Price_USD=price_USD, Price_PLN=price_USD * USD_to_PLN)
+
+
+def predict_file(input_path, output_path, chunk_size=50000, predictor=None, USD_to_PLN=None, verbose=False,
+                 normalize=True):
+    predictor = get_predictor().load(warmup=False) if predictor is None else predictor
+    USD_to_PLN = get_exchange_rate() if USD_to_PLN is None else USD_to_PLN
+    # Chunks are scored with categorical dtypes fixed by the vocabularies
+    vocabularies = load_vocabularies(predictor.folder_path)
+    normalizer = Normalizer(vocabularies) if normalize else None
+
+    writer = ChunkWriter(output_path)
+    start = time.perf_counter()
+    try:
+        for chunk in read_chunks(input_path, chunk_size):
+            writer.write(predict_prices(chunk, predictor, USD_to_PLN, vocabularies, normalizer))
+            if verbose:
+                elapsed = time.perf_counter() - start
+                print(f'{writer.rows_written:,} rows scored ({writer.rows_written / elapsed:,.0f} rows/sec)',
+                      file=sys.stderr)
+    finally:
+        writer.close()
+
+    seconds = time.perf_counter() - start
+    return {'rows': writer.rows_written, 'seconds': seconds,
+            'rows_per_second': writer.rows_written / seconds if seconds > 0 else 0.0,
+            'matches': normalizer.stats() if normalizer is not None else None}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Estimate prices of all cars in a CSV or Parquet file.')
+    parser.add_argument('input', help='CSV or Parquet file with one car per row')
+    parser.add_argument('output', help='CSV or Parquet file to write the input rows with estimated prices to')
+    parser.add_argument('--chunk-size', type=int, default=50000, help='number of rows scored at once')
+    parser.add_argument('--data-path', default=data_path, help='folder with preprocessor.pkl and simplified_model.pkl')
+    parser.add_argument('--quiet', action='store_true', help='do not report progress')
+    parser.add_argument('--no-normalize', action='store_true',
+                        help='score the values as given, without matching them to the vocabularies')
+    args = parser.parse_args(argv)
+
+    stats = predict_file(args.input, args.output, chunk_size=args.chunk_size,
+                         predictor=get_predictor(args.data_path).load(warmup=False), verbose=not args.quiet,
+                         normalize=not args.no_normalize)
+    for col, counts in (stats['matches'] or dict()).items():
+        print(f'{col}: ' + ', '.join(f'{kind} {count:,}' for kind, count in counts.items()))
+    print(f'Scored {stats["rows"]:,} rows in {stats["seconds"]:.2f} s ({stats["rows_per_second"]:,.0f} rows/sec)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+import argparse
+import gc
+import json
+import multiprocessing
+import pickle
+import platform
+import resource
+import statistics
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from car_market.aggregates import load_market_figure
+from car_market.artifacts import data_path, load_model, load_preprocessor, load_vocabularies
+from car_market.normalization import Normalizer
+from car_market.predictor import Predictor
+from car_market.rates import load_exchange_rates, rates_path
+from car_market.schema import INPUT_COLUMNS, prepare_input
+from car_market.transformers import CarFeaturesTransformer, CarsTransformer
+
+
+batch_sizes = [1, 100, 10000, 200000]
+chart_names = ['car_prices', 'production_years', 'car_brands', 'car_models', 'provinces', 'mileage', 'horsepowers',
+               'displacements', 'car_conditions', 'car_transmissions', 'car_drives', 'car_types', 'car_fuel_types']
+
+
+def synthetic_cars(vocabularies, n, seed=0):
+    # Random combinations of the vocabulary values within the slider ranges of the apps
+    rng = np.random.default_rng(seed)
+
+    def choice(values):
+        return np.asarray(values, dtype=object)[rng.integers(0, len(values), n)]
+
+    brands = choice(vocabularies['Vehicle_brand'])
+    models = [vocabularies['Vehicle_model'][brand] for brand in brands]
+    features = np.asarray(vocabularies['Features'], dtype=object)
+    has_feature = rng.random((n, len(features))) < rng.random((n, 1))
+    X = pd.DataFrame({'Condition': choice(vocabularies['Condition']), 'Vehicle_brand': brands,
+                      'Vehicle_model': [options[int(u * len(options))] for options, u in zip(models, rng.random(n))],
+                      'Production_year': rng.integers(1950, 2023, n), 'Mileage_km': rng.integers(0, 2001, n) * 500,
+                      'Power_HP': rng.integers(1, 1401, n), 'Displacement_cm3': rng.integers(4, 85, n) * 100.0,
+                      'Fuel_type': choice(vocabularies['Fuel_type']), 'Drive': choice(vocabularies['Drive']),
+                      'Transmission': choice(vocabularies['Transmission']), 'Type': choice(vocabularies['Type']),
+                      'Doors_number': rng.integers(1, 9, n), 'Colour': choice(vocabularies['Colour']),
+                      'Offer_location': choice(vocabularies['Offer_location']),
+                      'Features': [features[row].tolist() for row in has_feature]})
+    return X[INPUT_COLUMNS]
+
+
+def measure(function, repeat):
+    timings = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+class Benchmark:
+
+    def __init__(self, repeat=5, large_repeat=2):
+        self.repeat = repeat
+        self.large_repeat = large_repeat
+        self.results = list()
+
+    def run(self, name, function, batch_size=None):
+        repeat = self.repeat if batch_size is None or batch_size < 10000 else self.large_repeat
+        timings = measure(function, repeat)
+        best = min(timings)
+        result = {'name': name, 'batch_size': batch_size, 'repeat': repeat, 'best_s': best,
+                  'median_s': statistics.median(timings),
+                  'rows_per_second': batch_size / best if batch_size and best > 0 else None}
+        self.results.append(result)
+        rows = f' x{batch_size:,}' if batch_size else ''
+        print(f'{name}{rows}: best {best * 1000:,.3f} ms, median {result["median_s"] * 1000:,.3f} ms')
+        return result
+
+
+def run_benchmarks(folder_path=data_path, sizes=batch_sizes, repeat=5, large_repeat=2):
+    benchmark = Benchmark(repeat, large_repeat)
+
+    benchmark.run('load_vocabularies', lambda: load_vocabularies(folder_path))
+    benchmark.run('load_preprocessor', lambda: load_preprocessor(folder_path))
+    benchmark.run('load_model', lambda: load_model(folder_path))
+    benchmark.run('load_market_figures', lambda: [load_market_figure(name) for name in chart_names])
+    benchmark.run('load_exchange_rates', lambda: load_exchange_rates.__wrapped__(rates_path))
+    try:
+        from currency_converter import CurrencyConverter
+    except ImportError:
+        pass
+    else:
+        benchmark.run('CurrencyConverter', lambda: CurrencyConverter(fallback_on_missing_rate=True))
+
+    vocabularies = load_vocabularies(folder_path)
+    preprocessor = load_preprocessor(folder_path)
+    regressor = load_model(folder_path)
+    normalizer = Normalizer(vocabularies)
+    for size in sizes:
+        X = synthetic_cars(vocabularies, size)
+        cars_transformer = CarsTransformer('Vehicle_model').fit(X)
+        features_transformer = CarFeaturesTransformer().fit(X)
+        X_prepared = preprocessor.transform(X)
+
+        benchmark.run('Normalizer.normalize', lambda: normalizer.normalize(X), size)
+        benchmark.run('CarsTransformer.fit', lambda: CarsTransformer('Vehicle_model').fit(X), size)
+        benchmark.run('CarsTransformer.transform', lambda: cars_transformer.transform(X), size)
+        benchmark.run('CarFeaturesTransformer.fit', lambda: CarFeaturesTransformer().fit(X), size)
+        benchmark.run('CarFeaturesTransformer.transform', lambda: features_transformer.transform(X), size)
+        benchmark.run('preprocessor.transform', lambda: preprocessor.transform(X), size)
+        benchmark.run('XGBRegressor.predict', lambda: regressor.predict(X_prepared), size)
+        benchmark.run('end_to_end', lambda: regressor.predict(preprocessor.transform(X)), size)
+    return benchmark.results
+
+
+def raw_cars(vocabularies, n, seed=0):
+    # Synthetic cars as they are read from a CSV file, with the features written out as a list literal
+    X = synthetic_cars(vocabularies, n, seed)
+    return X.assign(Features=X['Features'].map(repr))
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if platform.system() == 'Darwin' else peak / 1024
+
+
+def score_raw_file(folder_path, raw_path, categorical):
+    # Runs in a fresh process, so the peak RSS growth belongs to a single variant
+    predictor = Predictor(folder_path, cache_size=0).load()
+    vocabularies = load_vocabularies(folder_path) if categorical else None
+    with open(raw_path, 'rb') as file:
+        raw = pickle.load(file)
+    gc.collect()
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    X = prepare_input(raw, vocabularies, predictor.preprocessor if categorical else None)
+    X_bytes = int(X.memory_usage(deep=True).sum())
+    prices = predictor.predict(X)
+    return {'seconds': time.perf_counter() - start, 'input_mb': X_bytes / 1024 ** 2,
+            'peak_rss_growth_mb': peak_rss_mb() - baseline}, prices
+
+
+def run_memory_benchmark(folder_path=data_path, size=200000):
+    with tempfile.TemporaryDirectory() as folder:
+        raw_path = Path(folder) / 'raw.pkl'
+        with open(raw_path, 'wb') as file:
+            pickle.dump(raw_cars(load_vocabularies(folder_path), size), file)
+
+        results, prices = dict(), dict()
+        context = multiprocessing.get_context('spawn')
+        for name, categorical in [('object', False), ('categorical', True)]:
+            with context.Pool(1) as pool:
+                results[name], prices[name] = pool.apply(score_raw_file, (str(folder_path), str(raw_path), categorical))
+            print(f'{name} dtypes x{size:,}: prepared input {results[name]["input_mb"]:,.1f} MiB, peak RSS growth '
+                  f'{results[name]["peak_rss_growth_mb"]:,.1f} MiB, {results[name]["seconds"]:.2f} s')
+    if not np.array_equal(prices['object'], prices['categorical']):
+        raise AssertionError('Categorical dtypes changed the predictions')
+    return {'batch_size': size, **results}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    previous = {(result['name'], result['batch_size']): result for result in baseline['results']}
+    for result in results:
+        old = previous.get((result['name'], result['batch_size']))
+        if old is not None:
+            rows = f' x{result["batch_size"]:,}' if result['batch_size'] else ''
+            print(f'{result["name"]}{rows}: {old["best_s"] / result["best_s"]:.2f}x speed of {baseline["commit"]}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time preprocessing, prediction and artifact loading on synthetic '
+                                                 'cars.')
+    parser.add_argument('--data-path', default=data_path, help='folder with the vocabularies, preprocessor and model')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file to save the results to')
+    parser.add_argument('--compare', default=None, help='results of an earlier run to compare with')
+    parser.add_argument('--sizes', type=int, nargs='+', default=batch_sizes, help='batch sizes in rows')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement')
+    parser.add_argument('--large-repeat', type=int, default=2, help='runs per measurement of 10k rows and more')
+    parser.add_argument('--memory', type=int, nargs='?', const=200000, default=None, metavar='ROWS',
+                        help='only compare peak RSS of scoring a raw batch with object and categorical dtypes')
+    args = parser.parse_args(argv)
+
+    report = {'commit': git_commit(), 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(), 'machine': platform.machine()}
+    if args.memory:
+        report['memory'] = run_memory_benchmark(args.data_path, args.memory)
+        Path(args.output).write_text(json.dumps(report, indent=2))
+        print(f'Results saved to {args.output}')
+        return
+
+    results = run_benchmarks(args.data_path, args.sizes, args.repeat, args.large_repeat)
+    report['results'] = results
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    print(f'Results saved to {args.output}')
+    if args.compare:
+        compare(results, json.loads(Path(args.compare).read_text()))
+
+
+if __name__ == '__main__':
+    main()
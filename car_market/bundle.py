@@ -0,0 +1,64 @@
+import argparse
+import io
+import json
+import pickle
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+import numpy as np
+from car_market.artifacts import Bundle, bundle_format_version, bundle_name, data_path, load_pickle, vocabulary_names
+from car_market.schema import default_car, make_frame
+
+
+def build_bundle(folder_path=data_path, output_path=None):
+    folder_path = Path(folder_path)
+    output_path = folder_path / bundle_name if output_path is None else Path(output_path)
+
+    vocabularies = {name: load_pickle(folder_path / f'{name}.pkl') for name in vocabulary_names}
+    preprocessor = load_pickle(folder_path / 'preprocessor.pkl')
+    regressor = load_pickle(folder_path / 'simplified_model.pkl')
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        model_path = Path(temp_dir) / 'model.json'
+        regressor.save_model(model_path)
+        model_data = model_path.read_bytes()
+
+    manifest = {'format_version': bundle_format_version, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'files': ['vocabularies.json', 'preprocessor.pkl', 'model.json']}
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+        archive.writestr('manifest.json', json.dumps(manifest, indent=2))
+        archive.writestr('vocabularies.json', json.dumps(vocabularies, ensure_ascii=False).encode('utf-8'))
+        archive.writestr('preprocessor.pkl', pickle.dumps(preprocessor, protocol=pickle.HIGHEST_PROTOCOL))
+        archive.writestr('model.json', model_data)
+    verify_bundle(buffer.getvalue(), vocabularies, preprocessor, regressor)
+    output_path.write_bytes(buffer.getvalue())
+    return output_path
+
+
+def verify_bundle(data, vocabularies, preprocessor, regressor):
+    # The apps prefer the bundle over the pickles, so one they cannot load must never be written
+    try:
+        bundle = Bundle(data)
+        car = make_frame([default_car(bundle.load_vocabularies())])
+        price = bundle.load_model().predict(bundle.load_preprocessor().transform(car))
+    except Exception as error:
+        raise ValueError(f'The model bundle cannot be loaded: {error}') from error
+    expected = regressor.predict(preprocessor.transform(make_frame([default_car(vocabularies)])))
+    if not np.allclose(price, expected, rtol=1e-5):
+        raise ValueError(f'The model bundle predicts {price[0]:,.2f} instead of {expected[0]:,.2f}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pack the vocabularies, preprocessor and model into one bundle file.')
+    parser.add_argument('--data-path', default=data_path, help='folder with the pickled artifacts')
+    parser.add_argument('--output', default=None, help=f'bundle path (defaults to {bundle_name} in the data folder)')
+    args = parser.parse_args(argv)
+
+    output_path = build_bundle(args.data_path, args.output)
+    print(f'Model bundle written to {output_path} ({output_path.stat().st_size / 1024:,.0f} KiB)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import threading
+import time
+from collections import OrderedDict
+from car_market.schema import INPUT_COLUMNS
+
+
+def make_key(car):
+    return tuple(tuple(sorted(car[col])) if col == 'Features' else car[col] for col in INPUT_COLUMNS)
+
+
+class PredictionCache:
+
+    def __init__(self, max_size=1024, ttl=None, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.artifact_hash = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def check_artifact(self, artifact_hash):
+        if artifact_hash != self.artifact_hash:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.artifact_hash = artifact_hash
+
+    def get(self, key, artifact_hash):
+        with self._lock:
+            self.check_artifact(artifact_hash)
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and entry[1] <= self.clock():
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, artifact_hash):
+        with self._lock:
+            self.check_artifact(artifact_hash)
+            expires = self.clock() + self.ttl if self.ttl is not None else None
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_predict(self, car, predict, artifact_hash):
+        key = make_key(car)
+        value = self.get(key, artifact_hash)
+        if value is None:
+            value = predict(car)
+            self.put(key, value, artifact_hash)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0, 'evictions': self.evictions,
+                    'expirations': self.expirations, 'invalidations': self.invalidations}
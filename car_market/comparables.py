@@ -0,0 +1,166 @@
+import argparse
+import json
+import threading
+import time
+import warnings
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import scipy.sparse
+from car_market.artifacts import artifact_hash, data_path, load_preprocessor, load_vocabularies
+from car_market.fast_path import percentile_ms, random_cars
+from car_market.predictor import get_predictor
+from car_market.training import read_training_data
+
+
+index_folder = 'comparables'
+index_format_version = 2
+listing_columns = ['Vehicle_brand', 'Vehicle_model', 'Production_year', 'Mileage_km', 'Power_HP', 'Displacement_cm3',
+                   'Fuel_type', 'Transmission', 'Type', 'Condition', 'Offer_location']
+
+
+def encode_rows(preprocessor, X, chunk_size=50000):
+    vectors = np.empty((len(X), 0), dtype=np.float32)
+    for start in range(0, len(X), chunk_size):
+        chunk = preprocessor.transform(X.iloc[start:start + chunk_size])
+        chunk = np.asarray(chunk.toarray() if scipy.sparse.issparse(chunk) else chunk, dtype=np.float32)
+        if start == 0:
+            vectors = np.empty((len(X), chunk.shape[1]), dtype=np.float32)
+        vectors[start:start + len(chunk)] = chunk
+    return vectors
+
+
+def partition_ranges(keys):
+    # keys are sorted, so every distinct key is one contiguous range of rows
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    ends = np.r_[starts[1:], len(keys)]
+    return {key: [int(start), int(end)] for key, start, end in zip(keys[starts].tolist(), starts, ends)}
+
+
+def build_index(input_path, folder_path=data_path, chunk_size=50000, n_jobs=None):
+    folder_path = Path(folder_path)
+    output_path = folder_path / index_folder
+    start = time.perf_counter()
+
+    parts, data_hash = read_training_data(input_path, chunk_size, n_jobs, test_size=0)
+    X = pd.concat([part[0] for part in parts], ignore_index=True)
+    price_USD = np.concatenate([part[1].to_numpy() for part in parts])
+    brands = X['Vehicle_brand'].fillna('').to_numpy(dtype=str)
+    models = X['Vehicle_model'].fillna('').to_numpy(dtype=str)
+    # Rows of one brand, and of one model within it, are stored next to each other
+    order = np.lexsort((models, brands))
+    X, price_USD, brands, models = X.iloc[order], price_USD[order], brands[order], models[order]
+
+    vectors = encode_rows(load_preprocessor(folder_path), X, chunk_size)
+    output_path.mkdir(parents=True, exist_ok=True)
+    np.save(output_path / 'vectors.npy', vectors)
+    np.save(output_path / 'norms.npy', np.einsum('ij,ij->i', vectors, vectors))
+    # An uncompressed Arrow file, so the listings are memory-mapped like the vectors
+    listings = pa.Table.from_pandas(X[listing_columns].assign(Price_USD=price_USD), preserve_index=False)
+    with pa.OSFile(str(output_path / 'listings.arrow'), 'wb') as file, \
+            pa.ipc.new_file(file, listings.schema) as writer:
+        writer.write_table(listings)
+
+    manifest = {'format_version': index_format_version, 'rows': len(X), 'columns': int(vectors.shape[1]),
+                'artifact_hash': artifact_hash(folder_path), 'data_hash': data_hash,
+                'brands': partition_ranges(brands),
+                'models': partition_ranges(np.char.add(np.char.add(brands, '\t'), models))}
+    (output_path / 'manifest.json').write_text(json.dumps(manifest))
+    return {'rows': len(X), 'columns': int(vectors.shape[1]), 'seconds': time.perf_counter() - start}
+
+
+class ComparablesIndex:
+
+    def __init__(self, path):
+        path = Path(path)
+        self.manifest = json.loads((path / 'manifest.json').read_text())
+        if self.manifest['format_version'] != index_format_version:
+            raise ValueError(f'Unsupported comparables index format version: {self.manifest["format_version"]}')
+        # Only the partitions that are searched are paged in
+        self.vectors = np.load(path / 'vectors.npy', mmap_mode='r')
+        self.norms = np.load(path / 'norms.npy', mmap_mode='r')
+        self.listings = pa.ipc.open_file(pa.memory_map(str(path / 'listings.arrow'))).read_all()
+
+    def partition(self, brand, model):
+        # Cars of an unknown model are compared with the whole brand, of an unknown brand with every advert
+        rows = self.manifest['models'].get(f'{brand}\t{model}') or self.manifest['brands'].get(brand)
+        return rows or [0, self.manifest['rows']]
+
+    def search(self, vector, brand, model, k=10):
+        start, end = self.partition(brand, model)
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        # Squared euclidean distances without materializing the differences
+        distances = self.norms[start:end] - 2 * (self.vectors[start:end] @ vector) + vector @ vector
+        k = min(k, len(distances))
+        nearest = np.argpartition(distances, k - 1)[:k] if k < len(distances) else np.arange(len(distances))
+        nearest = nearest[np.argsort(distances[nearest], kind='stable')]
+        listings = self.listings.take(pa.array(start + nearest)).to_pandas()
+        return listings.assign(Distance=np.sqrt(np.maximum(distances[nearest], 0)))
+
+    def search_car(self, predictor, car, k=10):
+        vector = predictor.encode_car(car)
+        # Checked after encoding, as a reload replaces the artifact hash before the preprocessor. The vectors of an
+        # index built with other artifacts are not comparable, so the index is dropped and None returned instead
+        if predictor.artifact_hash != self.manifest['artifact_hash']:
+            forget_comparables(self)
+            return None
+        return self.search(vector, car['Vehicle_brand'], car['Vehicle_model'], k)
+
+
+_indexes = dict()
+_indexes_lock = threading.Lock()
+
+
+def load_comparables(folder_path=data_path):
+    # None when the index was not built, or was built with other artifacts and would encode cars differently
+    folder_path = Path(folder_path).resolve()
+    with _indexes_lock:
+        if folder_path not in _indexes:
+            index = None
+            manifest_path = folder_path / index_folder / 'manifest.json'
+            if manifest_path.exists():
+                manifest = json.loads(manifest_path.read_text())
+                if manifest['format_version'] != index_format_version or \
+                        manifest['artifact_hash'] != artifact_hash(folder_path):
+                    warnings.warn('Comparables index is out of date, rebuild it with python -m car_market.comparables')
+                else:
+                    index = ComparablesIndex(folder_path / index_folder)
+            _indexes[folder_path] = index
+        return _indexes[folder_path]
+
+
+def forget_comparables(index):
+    # The next load_comparables reads the index again, or warns that it is out of date
+    with _indexes_lock:
+        for folder_path in [folder_path for folder_path, cached in _indexes.items() if cached is index]:
+            del _indexes[folder_path]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the index of adverts to find comparable listings in.')
+    parser.add_argument('input', nargs='?', help='raw advert CSV (Car_sale_ads.csv), omit to time the existing index')
+    parser.add_argument('--data-path', default=data_path, help='folder with the preprocessor and the model')
+    parser.add_argument('--chunk-size', type=int, default=50000, help='number of adverts prepared per worker task')
+    parser.add_argument('--n-jobs', type=int, default=None, help='worker processes (all cores)')
+    parser.add_argument('--repeat', type=int, default=200, help='number of timed searches')
+    args = parser.parse_args(argv)
+
+    if args.input:
+        stats = build_index(args.input, args.data_path, args.chunk_size, args.n_jobs)
+        print(f'Indexed {stats["rows"]:,} adverts with {stats["columns"]:,} columns in {stats["seconds"]:.1f} s')
+
+    index = load_comparables(args.data_path)
+    if index is None:
+        parser.error('no up-to-date comparables index, pass the advert CSV to build one')
+    predictor = get_predictor(args.data_path).enable_fast_path().load()
+    timings = list()
+    for car in random_cars(load_vocabularies(args.data_path), args.repeat, seed=1):
+        start = time.perf_counter()
+        index.search_car(predictor, car)
+        timings.append(time.perf_counter() - start)
+    print(f'Search of 10 comparables: p50 {percentile_ms(timings, 50):.3f} ms, p99 {percentile_ms(timings, 99):.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
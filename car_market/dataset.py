@@ -0,0 +1,70 @@
+import re
+import numpy as np
+import pandas as pd
+
+
+publication_date_format = '%d/%m/%Y'
+# Fixed dtypes keep row hashes stable between chunks and files (a chunk without missing mileage would parse it as int)
+raw_dtypes = {'Price': np.float64, 'Production_year': np.float64, 'Mileage_km': np.float64, 'Power_HP': np.float64,
+              'Displacement_cm3': np.float64, 'CO2_emissions': np.float64, 'Doors_number': np.float64,
+              'Currency': object, 'Condition': object, 'Vehicle_brand': object, 'Vehicle_model': object,
+              'Vehicle_version': object, 'Vehicle_generation': object, 'Fuel_type': object, 'Drive': object,
+              'Transmission': object, 'Type': object, 'Colour': object, 'Origin_country': object, 'First_owner': object,
+              'First_registration_date': object, 'Offer_publication_date': object, 'Offer_location': object,
+              'Features': object}
+feature_pattern = re.compile(r"'([^']*)'|\"([^\"]*)\"")
+
+
+def read_adverts(path, chunk_size=50000, columns=None):
+    if columns is not None:
+        return pd.read_csv(path, chunksize=chunk_size, usecols=columns, dtype=raw_dtypes)
+    # The first column of the Kaggle CSV is a row index
+    return pd.read_csv(path, chunksize=chunk_size, index_col=0, dtype=raw_dtypes)
+
+
+def parse_feature_string(value):
+    if not isinstance(value, str) or value == '[]':
+        return []
+    if '"' not in value:
+        # Plain repr of a list of strings: ['ABS', 'Alloy wheels']
+        return value[2:-2].split("', '")
+    return [single or double for single, double in feature_pattern.findall(value)]
+
+
+def extract_province(locations, provinces):
+    province = locations.str.rsplit(',', n=1).str[-1].str.strip().str.lower()
+    return province.where(province.isin(provinces), 'unknown')
+
+
+def publication_dates(adverts):
+    return pd.to_datetime(adverts['Offer_publication_date'], format=publication_date_format, errors='coerce')
+
+
+def prices_in_usd(adverts, exchange_rates):
+    rates = exchange_rates.rates_for(adverts['Currency'].to_numpy(), publication_dates(adverts).to_numpy(), 'USD')
+    return adverts['Price'] * rates
+
+
+class Deduplicator:
+
+    def __init__(self, known_hashes=None):
+        # Sorted hashes of adverts processed in earlier runs plus a set of the ones seen in this run
+        self.known_hashes = np.array([], dtype=np.uint64) if known_hashes is None else known_hashes
+        self.new_hashes = set()
+
+    def __call__(self, adverts):
+        hashes = pd.util.hash_pandas_object(adverts, index=False).values
+        positions = np.searchsorted(self.known_hashes, hashes).clip(max=max(len(self.known_hashes) - 1, 0))
+        known = self.known_hashes[positions] == hashes if len(self.known_hashes) else np.zeros(len(hashes), bool)
+        keep = np.zeros(len(hashes), dtype=bool)
+        for i in np.flatnonzero(~known):
+            if hashes[i] not in self.new_hashes:
+                self.new_hashes.add(hashes[i])
+                keep[i] = True
+        return adverts[keep]
+
+    def added_hashes(self):
+        return np.sort(np.fromiter(self.new_hashes, dtype=np.uint64, count=len(self.new_hashes)))
+
+    def all_hashes(self):
+        return np.union1d(self.known_hashes, self.added_hashes())
@@ -0,0 +1,137 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from sklearn.metrics import mean_squared_error, r2_score
+from xgboost.sklearn import XGBRegressor
+from car_market.artifacts import data_path, find_bundle, load_model, load_pickle, load_preprocessor
+from car_market.training import cache_path, read_training_data
+
+
+# Bumped whenever the layout of the cached matrices changes
+matrix_cache_version = 1
+
+
+def file_hash(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def preprocessor_hash(folder_path=data_path):
+    # The pickled bytes, as a fitted preprocessor fills some of its lookups lazily on first use
+    bundle = find_bundle(folder_path)
+    if bundle is not None:
+        return hashlib.sha256(bundle.archive.read('preprocessor.pkl')).hexdigest()
+    return file_hash(Path(folder_path) / 'preprocessor.pkl')
+
+
+def matrix_key(input_path, folder_path, test_size):
+    config = json.dumps({'data_hash': file_hash(input_path), 'preprocessor_hash': preprocessor_hash(folder_path),
+                         'test_size': test_size, 'version': matrix_cache_version}, sort_keys=True)
+    return hashlib.sha256(config.encode()).hexdigest()
+
+
+def write_matrix(path, preprocessor, X, chunk_size=50000):
+    # Filled chunk by chunk, so the whole matrix is never held in memory
+    matrix = None
+    for start in range(0, len(X), chunk_size):
+        chunk = preprocessor.transform(X.iloc[start:start + chunk_size])
+        chunk = chunk.toarray() if scipy.sparse.issparse(chunk) else chunk
+        if matrix is None:
+            matrix = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(len(X), chunk.shape[1]))
+        matrix[start:start + len(chunk)] = chunk
+    matrix.flush()
+    del matrix
+
+
+def build_matrix(input_path, folder, key, folder_path=data_path, chunk_size=50000, n_jobs=None, test_size=0.2):
+    parts, data_hash = read_training_data(input_path, chunk_size, n_jobs, test_size)
+    X = pd.concat([part[0] for part in parts], ignore_index=True)
+    y = np.concatenate([part[1].to_numpy() for part in parts])
+    test = np.concatenate([part[2] for part in parts])
+    # Held-out rows come first, so they are a plain slice of the mapped file
+    order = np.concatenate([np.flatnonzero(test), np.flatnonzero(~test)])
+
+    folder.mkdir(parents=True, exist_ok=True)
+    partial = folder / f'features-{key[:16]}.partial.npy'
+    write_matrix(partial, load_preprocessor(folder_path), X.iloc[order], chunk_size)
+    np.save(folder / f'target-{key[:16]}.npy', y[order])
+    (folder / f'features-{key[:16]}.json').write_text(json.dumps({
+        'rows': len(X), 'test_rows': int(test.sum()), 'data_hash': data_hash, 'test_size': test_size}))
+    # The matrix only gets its final name once it is complete
+    os.replace(partial, folder / f'features-{key[:16]}.npy')
+
+
+def load_matrix(input_path, folder_path=data_path, cache_folder=cache_path, chunk_size=50000, n_jobs=None,
+                test_size=0.2):
+    start = time.perf_counter()
+    folder = Path(cache_folder)
+    key = matrix_key(input_path, folder_path, test_size)
+    cached = (folder / f'features-{key[:16]}.npy').exists()
+    if not cached:
+        build_matrix(input_path, folder, key, folder_path, chunk_size, n_jobs, test_size)
+    info = json.loads((folder / f'features-{key[:16]}.json').read_text())
+    return {'X': np.load(folder / f'features-{key[:16]}.npy', mmap_mode='r'),
+            'y': np.load(folder / f'target-{key[:16]}.npy', mmap_mode='r'),
+            'test_rows': info['test_rows'], 'cached': cached, 'seconds': time.perf_counter() - start}
+
+
+def load_candidate(path):
+    path = Path(path)
+    if path.is_dir():
+        return load_model(path)
+    if path.suffix in ('.json', '.ubj'):
+        regressor = XGBRegressor()
+        regressor.load_model(path)
+        return regressor
+    return load_pickle(path)
+
+
+def evaluate_model(regressor, X, y):
+    start = time.perf_counter()
+    # XGBoost reads the mapped float32 rows in place
+    predictions = regressor.predict(X)
+    return {'rmse': float(np.sqrt(mean_squared_error(y, predictions))), 'r2': float(r2_score(y, predictions)),
+            'rows': len(y), 'seconds': time.perf_counter() - start}
+
+
+def compare_models(input_path, model_paths, folder_path=data_path, cache_folder=cache_path, chunk_size=50000,
+                   n_jobs=None, test_size=0.2, all_rows=False):
+    matrix = load_matrix(input_path, folder_path, cache_folder, chunk_size, n_jobs, test_size)
+    rows = len(matrix['y']) if all_rows else matrix['test_rows']
+    X, y = matrix['X'][:rows], matrix['y'][:rows]
+    results = {str(path): evaluate_model(load_candidate(path), X, y) for path in model_paths}
+    return {'cached': matrix['cached'], 'matrix_seconds': matrix['seconds'], 'models': results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare candidate models on the cached preprocessed adverts.')
+    parser.add_argument('input', help='raw advert CSV (Car_sale_ads.csv from the Kaggle dataset)')
+    parser.add_argument('models', nargs='*', help='candidate simplified_model.pkl, XGBoost JSON or artifact folders '
+                                                  '(the model of --data-path by default)')
+    parser.add_argument('--data-path', default=data_path, help='folder with the preprocessor the candidates expect')
+    parser.add_argument('--cache-path', default=cache_path, help='folder with the cached feature matrices')
+    parser.add_argument('--chunk-size', type=int, default=50000, help='number of adverts prepared per worker task')
+    parser.add_argument('--n-jobs', type=int, default=None, help='worker processes (all cores)')
+    parser.add_argument('--test-size', type=float, default=0.2, help='fraction of adverts held out for evaluation')
+    parser.add_argument('--all-rows', action='store_true', help='evaluate on all adverts instead of the held-out ones')
+    args = parser.parse_args(argv)
+
+    report = compare_models(args.input, args.models or [args.data_path], args.data_path, args.cache_path,
+                            args.chunk_size, args.n_jobs, args.test_size, args.all_rows)
+    print(f'Feature matrix {"mapped from cache" if report["cached"] else "built"} in {report["matrix_seconds"]:.2f} s')
+    for path, result in report['models'].items():
+        print(f'{path}: RMSE {result["rmse"]:,.0f} USD, R2 {result["r2"]:.3f} on {result["rows"]:,} adverts '
+              f'in {result["seconds"]:.2f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+import argparse
+import random
+import time
+import numpy as np
+import scipy.sparse
+from car_market.artifacts import data_path, load_model, load_preprocessor, load_vocabularies
+from car_market.profiling import profiler
+from car_market.schema import default_car, make_frame, vocabulary_categories
+
+
+categorical_fields = ['Condition', 'Vehicle_brand', 'Vehicle_model', 'Fuel_type', 'Drive', 'Transmission', 'Type',
+                      'Colour', 'Offer_location']
+# Slider ranges of the web and desktop apps
+numeric_domains = {'Production_year': list(range(1950, 2023)), 'Mileage_km': list(range(0, 1000001, 500)),
+                   'Power_HP': list(range(1, 1401)), 'Doors_number': list(range(1, 9)),
+                   'Displacement_cm3': sorted({round(value * 100) for value in range(4, 85)})}
+# The desktop computes displacements as value * 0.1 * 1000, which gives float near-duplicates such as 700.0000000000001
+probe_domains = dict(numeric_domains, Displacement_cm3=sorted(set(numeric_domains['Displacement_cm3']) |
+                                                              {value * 0.1 * 1000 for value in range(4, 85)}))
+
+
+class NotSeparableError(ValueError):
+    pass
+
+
+class RowEncoder:
+
+    def __init__(self, preprocessor, vocabularies):
+        self.preprocessor = preprocessor
+        self.base_car = default_car(vocabularies)
+        self.base_row = self.transform([self.base_car])[0]
+        self.row = self.base_row.reshape(1, -1).copy()
+        self.owners = np.full(len(self.base_row), None, dtype=object)
+        self.layout = dict()
+        self.features_layout = dict()
+
+        domains = {field: vocabulary_categories(vocabularies, field) for field in categorical_fields}
+        domains.update(probe_domains)
+        for field, values in domains.items():
+            self.freeze_field(field, values)
+        self.freeze_features(vocabularies['Features'])
+
+    def transform(self, cars):
+        X_prepared = self.preprocessor.transform(make_frame(cars))
+        if scipy.sparse.issparse(X_prepared):
+            X_prepared = X_prepared.toarray()
+        return np.asarray(X_prepared, dtype=np.float32)
+
+    def claim_columns(self, owner, cols):
+        foreign = [other for other in self.owners[cols] if other is not None and other != owner]
+        if foreign:
+            raise NotSeparableError(f'{owner} shares preprocessed columns with {foreign[0]}')
+        self.owners[cols] = owner
+
+    def freeze_field(self, field, values):
+        encoded = self.transform([dict(self.base_car, **{field: value}) for value in values])
+        cols = np.flatnonzero((encoded != self.base_row).any(axis=0))
+        self.claim_columns(field, cols)
+        self.layout[field] = (cols, {value: row[cols] for value, row in zip(values, encoded)})
+
+    def freeze_features(self, features):
+        encoded = self.transform([dict(self.base_car, Features=[feature]) for feature in features])
+        for feature, row in zip(features, encoded):
+            cols = np.flatnonzero(row != self.base_row)
+            self.claim_columns(f'Features[{feature}]', cols)
+            self.features_layout[feature] = (cols, row[cols])
+
+    def probe_field(self, field, value):
+        row = self.transform([dict(self.base_car, **{field: value})])[0]
+        cols, table = self.layout[field]
+        new_cols = np.setdiff1d(np.flatnonzero(row != self.base_row), cols)
+        if len(new_cols):
+            # Values outside the frozen domain may switch on columns no probed value used (e.g. 'Other')
+            self.claim_columns(field, new_cols)
+            cols = np.concatenate([cols, new_cols])
+            table = {known: np.concatenate([values, self.base_row[new_cols]]) for known, values in table.items()}
+        table[value] = row[cols]
+        self.layout[field] = (cols, table)
+        return cols, table[value]
+
+    def probe_feature(self, feature):
+        self.freeze_features([feature])
+        return self.features_layout[feature]
+
+    def new_row(self):
+        return self.base_row.reshape(1, -1).copy()
+
+    def set_field(self, field, value, row=None):
+        cols, table = self.layout[field]
+        values = table.get(value)
+        if values is None:
+            cols, values = self.probe_field(field, value)
+        (self.row if row is None else row)[0, cols] = values
+
+    def set_features(self, features, row=None):
+        row = self.row if row is None else row
+        for cols, _ in self.features_layout.values():
+            row[0, cols] = self.base_row[cols]
+        for feature in features:
+            cols, values = self.features_layout.get(feature) or self.probe_feature(feature)
+            row[0, cols] = values
+
+    def encode(self, car):
+        for field in self.layout:
+            self.set_field(field, car[field])
+        self.set_features(car['Features'])
+        return self.row
+
+
+class FastPredictor:
+
+    def __init__(self, preprocessor, regressor, vocabularies, verify_samples=50):
+        self.encoder = RowEncoder(preprocessor, vocabularies)
+        self.booster = regressor.get_booster()
+        best_iteration = self.booster.attr('best_iteration')
+        self.iteration_range = (0, int(best_iteration) + 1) if best_iteration is not None else (0, 0)
+        if verify_samples:
+            self.verify(regressor, random_cars(vocabularies, verify_samples))
+
+    def predict_row(self, row):
+        return self.booster.inplace_predict(row, iteration_range=self.iteration_range, validate_features=False)[0]
+
+    def predict_car(self, car):
+        with profiler.stage('fast_path.encode'):
+            row = self.encoder.encode(car)
+        with profiler.stage('fast_path.predict'):
+            return float(self.predict_row(row))
+
+    def verify(self, regressor, cars):
+        expected = regressor.predict(self.encoder.preprocessor.transform(make_frame(cars)))
+        for car, price in zip(cars, expected):
+            if self.predict_car(car) != float(price):
+                raise NotSeparableError(f'Fast path prediction differs from the preprocessor for {car}')
+
+
+class LivePreview:
+
+    def __init__(self, fast_predictor):
+        # A row of its own, so estimates of other cars do not disturb the one being edited
+        self.fast_predictor = fast_predictor
+        self.row = fast_predictor.encoder.new_row()
+        self.car = dict(fast_predictor.encoder.base_car)
+
+    def predict_car(self, car):
+        encoder = self.fast_predictor.encoder
+        for field, value in car.items():
+            if self.car.get(field) != value:
+                if field == 'Features':
+                    encoder.set_features(value, self.row)
+                else:
+                    encoder.set_field(field, value, self.row)
+        self.car = dict(car)
+        return float(self.fast_predictor.predict_row(self.row))
+
+
+def random_cars(vocabularies, n, seed=0):
+    rng = random.Random(seed)
+    cars = list()
+    for _ in range(n):
+        brand = rng.choice(vocabularies['Vehicle_brand'])
+        car = {field: rng.choice(vocabularies[field]) for field in categorical_fields if field != 'Vehicle_model'}
+        car.update({field: rng.choice(values) for field, values in numeric_domains.items()})
+        car.update({'Vehicle_brand': brand, 'Vehicle_model': rng.choice(vocabularies['Vehicle_model'][brand]),
+                    'Features': rng.sample(vocabularies['Features'], rng.randint(0, len(vocabularies['Features'])))})
+        cars.append(car)
+    return cars
+
+
+def percentile_ms(timings, percentile):
+    return np.percentile(timings, percentile) * 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare single-row latency of the regular and the fast path.')
+    parser.add_argument('--data-path', default=data_path, help='folder with the preprocessor and the model')
+    parser.add_argument('--repeat', type=int, default=1000, help='number of timed predictions per path')
+    args = parser.parse_args(argv)
+
+    vocabularies = load_vocabularies(args.data_path)
+    preprocessor = load_preprocessor(args.data_path)
+    regressor = load_model(args.data_path)
+    start = time.perf_counter()
+    fast_predictor = FastPredictor(preprocessor, regressor, vocabularies)
+    print(f'Fast path built and verified in {(time.perf_counter() - start) * 1000:.1f} ms')
+
+    cars = random_cars(vocabularies, args.repeat, seed=1)
+    for name, predict in [('regular', lambda car: regressor.predict(preprocessor.transform(make_frame([car])))[0]),
+                          ('fast', fast_predictor.predict_car)]:
+        timings = list()
+        for car in cars:
+            start = time.perf_counter()
+            predict(car)
+            timings.append(time.perf_counter() - start)
+        print(f'{name} path: p50 {percentile_ms(timings, 50):.3f} ms, p99 {percentile_ms(timings, 99):.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+import argparse
+import json
+import re
+from pathlib import Path
+
+
+visualization_path = Path(__file__).parents[1] / 'visualization'
+figures_path = visualization_path / 'figures'
+separator_pattern = re.compile(r'[\s,]*')
+
+
+def extract_figure(html):
+    # The plotly.js bundle embedded in the page mentions Plotly.newPlot too, the figure call comes last
+    position = html.rindex('Plotly.newPlot(') + len('Plotly.newPlot(')
+    decoder = json.JSONDecoder()
+    arguments = list()
+    for _ in range(4):
+        position = separator_pattern.match(html, position).end()
+        argument, position = decoder.raw_decode(html, position)
+        arguments.append(argument)
+    _, data, layout, config = arguments
+    return {'data': data, 'layout': layout, 'config': config}
+
+
+def build_figures(html_path=visualization_path, output_path=figures_path):
+    output_path = Path(output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+    sizes = dict()
+    for path in sorted(Path(html_path).glob('*.html')):
+        figure = extract_figure(path.read_text(encoding='utf-8'))
+        figure_path = output_path / f'{path.stem}.json'
+        figure_path.write_text(json.dumps(figure, ensure_ascii=False, separators=(',', ':')), encoding='utf-8')
+        sizes[path.name] = (path.stat().st_size, figure_path.stat().st_size)
+    return sizes
+
+
+def load_figure(name, folder_path=figures_path):
+    return json.loads((Path(folder_path) / f'{name}.json').read_text(encoding='utf-8'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Extract the Plotly figure specs from the standalone chart pages.')
+    parser.add_argument('--html-path', default=visualization_path, help='folder with the exported chart pages')
+    parser.add_argument('--output', default=figures_path, help='folder to write the figure JSON files to')
+    args = parser.parse_args(argv)
+
+    sizes = build_figures(args.html_path, args.output)
+    for name, (html_size, figure_size) in sizes.items():
+        print(f'{name}: {html_size / 1024:,.0f} KiB -> {figure_size / 1024:,.1f} KiB')
+    print(f'Total: {sum(size[0] for size in sizes.values()) / 1024 ** 2:,.1f} MiB -> '
+          f'{sum(size[1] for size in sizes.values()) / 1024:,.1f} KiB')
+
+
+if __name__ == '__main__':
+    main()
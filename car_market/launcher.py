@@ -0,0 +1,173 @@
+import argparse
+import asyncio
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+from pathlib import Path
+from car_market.artifacts import data_path, load_vocabularies
+from car_market.predictor import get_predictor
+from car_market.rates import load_exchange_rates
+from car_market.service import PredictionService
+
+
+def smaps_rollup(pid):
+    # Sizes in KiB of all mappings of the process, summed up by the kernel (Linux 4.14+)
+    sizes = dict()
+    for line in Path(f'/proc/{pid}/smaps_rollup').read_text().splitlines()[1:]:
+        name, _, value = line.partition(':')
+        parts = value.split()
+        if len(parts) == 2 and parts[1] == 'kB':
+            sizes[name] = int(parts[0])
+    return sizes
+
+
+def process_memory(pid):
+    sizes = smaps_rollup(pid)
+    # Unique pages would be freed with the process, shared ones are still mapped by the parent or another worker
+    return {'rss_mb': sizes['Rss'] / 1024, 'pss_mb': sizes['Pss'] / 1024,
+            'shared_mb': (sizes['Shared_Clean'] + sizes['Shared_Dirty']) / 1024,
+            'unique_mb': (sizes['Private_Clean'] + sizes['Private_Dirty']) / 1024}
+
+
+def memory_report(parent_pid, worker_pids):
+    report = {'parent': {'pid': parent_pid, **process_memory(parent_pid)}, 'workers': list()}
+    for pid in worker_pids:
+        try:
+            report['workers'].append({'pid': pid, **process_memory(pid)})
+        except FileNotFoundError:
+            pass
+    # PSS splits every shared page among the processes mapping it, so its sum is what the host really pays
+    report['total_pss_mb'] = report['parent']['pss_mb'] + sum(worker['pss_mb'] for worker in report['workers'])
+    report['total_rss_mb'] = report['parent']['rss_mb'] + sum(worker['rss_mb'] for worker in report['workers'])
+    return report
+
+
+def print_memory_report(report, file=sys.stderr):
+    print(f'{"process":>16} {"RSS MiB":>9} {"PSS MiB":>9} {"shared MiB":>11} {"unique MiB":>11}', file=file)
+    for name, stats in [(f'parent {report["parent"]["pid"]}', report['parent'])] + \
+            [(f'worker {worker["pid"]}', worker) for worker in report['workers']]:
+        print(f'{name:>16} {stats["rss_mb"]:>9,.1f} {stats["pss_mb"]:>9,.1f} {stats["shared_mb"]:>11,.1f} '
+              f'{stats["unique_mb"]:>11,.1f}', file=file)
+    print(f'Sum of RSS {report["total_rss_mb"]:,.1f} MiB, actually used (PSS) {report["total_pss_mb"]:,.1f} MiB',
+          file=file)
+
+
+class Launcher:
+
+    def __init__(self, workers=4, host='127.0.0.1', port=8000, folder_path=data_path, max_batch_size=256,
+                 max_wait=0.005):
+        if not hasattr(os, 'fork'):
+            raise RuntimeError('Forking workers needs a POSIX system')
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.folder_path = folder_path
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.predictor = None
+        self.sock = None
+        self.worker_pids = set()
+        self.stopping = False
+
+    def preload(self):
+        # Everything the workers read is loaded before forking, so its pages are shared copy-on-write
+        load_vocabularies(self.folder_path)
+        load_exchange_rates()
+        self.predictor = get_predictor(self.folder_path).enable_fast_path().load()
+        gc.collect()
+        # Objects loaded so far are left out of garbage collections, which would otherwise write to (and so copy)
+        # every page holding them in each worker
+        gc.freeze()
+        return self
+
+    def bind(self):
+        # One listening socket inherited by all workers, the kernel hands each connection to one of them
+        self.sock = socket.create_server((self.host, self.port), backlog=1024)
+        self.sock.setblocking(False)
+        return self.sock
+
+    async def serve_worker(self):
+        service = PredictionService(self.predictor, self.max_batch_size, self.max_wait)
+        server = await service.start(sock=self.sock)
+        async with server:
+            await server.serve_forever()
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.worker_pids.add(pid)
+            return pid
+        code = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+            asyncio.run(self.serve_worker())
+        except BaseException:
+            code = 1
+        finally:
+            os._exit(code)
+
+    def stop(self, *_):
+        self.stopping = True
+        for pid in list(self.worker_pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def report(self, *_):
+        print_memory_report(memory_report(os.getpid(), sorted(self.worker_pids)))
+
+    def run(self, report_after=None):
+        self.bind()
+        self.preload()
+        for _ in range(self.workers):
+            self.spawn()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGUSR1, self.report)
+        print(f'Serving price estimates on http://{self.host}:{self.sock.getsockname()[1]}/predict '
+              f'with {self.workers} workers (kill -USR1 {os.getpid()} prints a memory report)')
+        if report_after is not None:
+            signal.signal(signal.SIGALRM, self.report)
+            signal.alarm(report_after)
+
+        while self.worker_pids:
+            try:
+                pid, _ = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            self.worker_pids.discard(pid)
+            if not self.stopping:
+                # A crashed worker is replaced by a new fork of the parent, which still holds the artifacts
+                time.sleep(0.1)
+                self.spawn()
+        self.sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve price estimates from several worker processes forked after '
+                                                 'loading the model once.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+    parser.add_argument('--data-path', default=data_path, help='folder with the preprocessor and the model')
+    parser.add_argument('--max-batch-size', type=int, default=256, help='maximum number of cars scored at once')
+    parser.add_argument('--max-wait-ms', type=float, default=5.0,
+                        help='how long the first queued request waits for others to join its batch')
+    parser.add_argument('--report-after', type=int, default=None, metavar='SECONDS',
+                        help='print a memory report of the parent and the workers after this many seconds')
+    args = parser.parse_args(argv)
+
+    Launcher(args.workers, args.host, args.port, args.data_path, args.max_batch_size,
+             args.max_wait_ms / 1000).run(args.report_after)
+
+
+if __name__ == '__main__':
+    main()
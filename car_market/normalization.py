@@ -0,0 +1,172 @@
+import argparse
+import re
+import time
+import unicodedata
+from collections import Counter
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from car_market.artifacts import data_path, load_vocabularies
+from car_market.schema import CATEGORICAL_COLUMNS, vocabulary_categories
+
+
+match_kinds = ['exact', 'casefold', 'alias', 'fuzzy', 'unmatched', 'missing']
+# Common spellings that no case folding or n-gram similarity gets to
+aliases = {'Vehicle_brand': {'vw': 'Volkswagen', 'mercedes': 'Mercedes-Benz', 'merc': 'Mercedes-Benz',
+                             'benz': 'Mercedes-Benz', 'alfa': 'Alfa Romeo', 'chevy': 'Chevrolet', 'vauxhall': 'Opel',
+                             'landrover': 'Land Rover', 'range rover': 'Land Rover'},
+           'Colour': {'grey': 'gray', 'silver grey': 'silver', 'gold': 'golden', 'purple': 'violet',
+                      'maroon': 'burgundy'},
+           'Fuel_type': {'petrol': 'Gasoline', 'gas': 'Gasoline', 'benzyna': 'Gasoline', 'lpg': 'Gasoline + LPG',
+                         'cng': 'Gasoline + CNG', 'ev': 'Electric', 'diesel oil': 'Diesel'},
+           'Transmission': {'auto': 'Automatic', 'automat': 'Automatic', 'manualna': 'Manual',
+                            'automatyczna': 'Automatic'},
+           'Drive': {'fwd': 'Front wheels', 'rwd': 'Rear wheels'},
+           'Type': {'estate': 'station_wagon', 'wagon': 'station_wagon', 'kombi': 'station_wagon',
+                    'hatchback': 'compact', 'cabrio': 'convertible', 'van': 'minivan'},
+           'Condition': {'second hand': 'Used', 'nowy': 'New', 'uzywany': 'Used'}}
+# Letters that Unicode does not decompose into a base letter and a diacritic
+special_letters = str.maketrans({'ł': 'l', 'ø': 'o', 'đ': 'd'})
+
+
+def fold(value):
+    # Case, diacritics, punctuation and repeated whitespace do not matter: ' Škoda ' and 'skoda' fold the same
+    value = unicodedata.normalize('NFKD', str(value).casefold().translate(special_letters))
+    value = ''.join(char for char in value if not unicodedata.combining(char))
+    return ' '.join(re.sub(r'[\W_]+', ' ', value).split())
+
+
+def trigrams(key):
+    padded = f'  {key} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class VocabularyIndex:
+
+    def __init__(self, values, aliases=None, min_similarity=0.6, cache_size=65536, separator=None):
+        self.values = list(values)
+        self.separator = separator
+        self.exact = {value: value for value in self.values}
+        self.folded = dict()
+        for value in self.values:
+            self.folded.setdefault(fold(value), value)
+        self.aliases = {fold(alias): value for alias, value in (aliases or dict()).items() if value in self.exact}
+        self.min_similarity = min_similarity
+
+        # Inverted index of character trigrams, the fuzzy stage counts the trigrams shared with every value at once
+        self.keys = list(self.folded)
+        self.sizes = np.array([len(trigrams(key)) for key in self.keys], dtype=np.float64)
+        postings = dict()
+        for i, key in enumerate(self.keys):
+            for trigram in trigrams(key):
+                postings.setdefault(trigram, list()).append(i)
+        self.postings = {trigram: np.array(ids, dtype=np.int64) for trigram, ids in postings.items()}
+        self.resolve = lru_cache(maxsize=cache_size)(self._resolve)
+
+    def _resolve(self, value):
+        if pd.isna(value):
+            return value, 'missing'
+        if value in self.exact:
+            return value, 'exact'
+        key = fold(value)
+        if key in self.folded:
+            return self.folded[key], 'casefold'
+        if key in self.aliases:
+            return self.aliases[key], 'alias'
+        if self.separator is not None and self.separator in str(value):
+            # Only the last part is matched, e.g. the province of 'city, province'
+            resolved, kind = self.resolve(str(value).rsplit(self.separator, 1)[-1].strip())
+            return (value, kind) if kind == 'unmatched' else (resolved, kind)
+        match = self.fuzzy(key)
+        return (value, 'unmatched') if match is None else (match, 'fuzzy')
+
+    def fuzzy(self, key):
+        query = trigrams(key)
+        ids = [self.postings[trigram] for trigram in query if trigram in self.postings]
+        if len(key) < 3 or not ids:
+            return None
+        shared = np.bincount(np.concatenate(ids), minlength=len(self.keys))
+        # Dice coefficient of the trigram sets, ties go to the value listed first in the vocabulary
+        similarity = 2 * shared / (len(query) + self.sizes)
+        best = int(similarity.argmax())
+        return self.folded[self.keys[best]] if similarity[best] >= self.min_similarity else None
+
+    def resolve_column(self, column):
+        # Every distinct value is resolved once, the rows only get the resolutions by their codes
+        codes, uniques = pd.factorize(column)
+        return self.apply_resolutions(column, codes, [self.resolve(value) for value in uniques])
+
+    @staticmethod
+    def apply_resolutions(column, codes, resolutions):
+        values = np.array([value for value, _ in resolutions] + [None], dtype=object)
+        kinds = np.array([match_kinds.index(kind) for _, kind in resolutions] + [match_kinds.index('missing')])
+        resolved = pd.Series(np.where(codes >= 0, values[codes], column.to_numpy(dtype=object)), index=column.index)
+        counts = np.bincount(kinds[codes], minlength=len(match_kinds))
+        return resolved, Counter({kind: int(count) for kind, count in zip(match_kinds, counts) if count})
+
+
+class Normalizer:
+
+    def __init__(self, vocabularies, min_similarity=0.6, cache_size=65536):
+        self.min_similarity = min_similarity
+        self.cache_size = cache_size
+        # Offer locations are often written as 'city, province'
+        self.indexes = {col: VocabularyIndex(vocabulary_categories(vocabularies, col), aliases.get(col),
+                                             min_similarity, cache_size, ',' if col == 'Offer_location' else None)
+                        for col in CATEGORICAL_COLUMNS if col != 'Vehicle_model'}
+        # Models are looked up among the models of the resolved brand, the indexes are built on first use
+        self.brand_models = vocabularies['Vehicle_model']
+        self.model_indexes = dict()
+        self.resolve_model = lru_cache(maxsize=cache_size)(self._resolve_model)
+        self.matches = {col: Counter() for col in CATEGORICAL_COLUMNS}
+        self.rows = 0
+
+    def _resolve_model(self, brand, model):
+        if pd.isna(model):
+            return model, 'missing'
+        if brand not in self.brand_models:
+            return model, 'unmatched'
+        if brand not in self.model_indexes:
+            self.model_indexes[brand] = VocabularyIndex(self.brand_models[brand], None, self.min_similarity,
+                                                        self.cache_size)
+        return self.model_indexes[brand].resolve(model)
+
+    def normalize(self, data):
+        columns = dict()
+        for col, index in self.indexes.items():
+            columns[col], counts = index.resolve_column(data[col])
+            self.matches[col].update(counts)
+
+        brands, models = columns['Vehicle_brand'], data['Vehicle_model']
+        codes, pairs = pd.MultiIndex.from_arrays([brands.to_numpy(dtype=object), models.to_numpy(dtype=object)]) \
+            .factorize()
+        columns['Vehicle_model'], counts = VocabularyIndex.apply_resolutions(
+            models, codes, [self.resolve_model(brand, model) for brand, model in pairs])
+        self.matches['Vehicle_model'].update(counts)
+        self.rows += len(data)
+        return data.assign(**columns)
+
+    def stats(self):
+        return {col: {kind: self.matches[col][kind] for kind in match_kinds if self.matches[col][kind]}
+                for col in CATEGORICAL_COLUMNS}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Report how free-text values of a car file match the vocabularies.')
+    parser.add_argument('input', help='CSV file with one car per row')
+    parser.add_argument('--data-path', default=data_path, help='folder with the vocabularies')
+    parser.add_argument('--min-similarity', type=float, default=0.6, help='trigram similarity of a fuzzy match')
+    args = parser.parse_args(argv)
+
+    data = pd.read_csv(args.input, usecols=CATEGORICAL_COLUMNS)
+    normalizer = Normalizer(load_vocabularies(args.data_path), args.min_similarity)
+    start = time.perf_counter()
+    normalizer.normalize(data)
+    seconds = time.perf_counter() - start
+    for col, counts in normalizer.stats().items():
+        print(f'{col}: ' + ', '.join(f'{kind} {count:,}' for kind, count in counts.items()))
+    print(f'Normalized {len(data):,} rows in {seconds:.2f} s ({len(data) / seconds:,.0f} rows/sec)')
+
+
+if __name__ == '__main__':
+    main()
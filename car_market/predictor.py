@@ -0,0 +1,227 @@
+import argparse
+import threading
+import time
+import warnings
+from pathlib import Path
+import numpy as np
+import scipy.sparse
+from car_market.artifacts import artifact_hash, artifact_stamp, data_path, load_model, load_preprocessor, \
+    load_vocabularies
+from car_market.cache import PredictionCache
+from car_market.fast_path import FastPredictor, LivePreview, NotSeparableError
+from car_market.profiling import profiler, timed_transform
+from car_market.schema import default_car, make_frame
+
+
+class Predictor:
+
+    def __init__(self, folder_path=data_path, cache_size=1024, cache_ttl=None, reload_check_interval=5.0):
+        self.folder_path = Path(folder_path)
+        # Swapped as one tuple on reload, so a prediction never pairs the preprocessor of one version with another model
+        self.artifacts = None
+        self.artifact_hash = None
+        self.artifact_stamp = None
+        self.reload_check_interval = reload_check_interval
+        self.last_reload_check = 0.0
+        self.cache = None
+        self.load_seconds = None
+        self.warmup_seconds = None
+        self.first_predict_seconds = None
+        self.use_fast_path = False
+        self.fast_predictor = None
+        self.live_preview = None
+        self._lock = threading.RLock()
+        self._preload_thread = None
+        self.configure_cache(cache_size, cache_ttl)
+
+    def configure_cache(self, cache_size=1024, cache_ttl=None):
+        # A size of 0 disables the cache, a changed size or TTL starts an empty one
+        with self._lock:
+            if self.cache is None or (self.cache.max_size, self.cache.ttl) != (cache_size, cache_ttl):
+                self.cache = PredictionCache(cache_size, cache_ttl) if cache_size else None
+        return self
+
+    def cache_stats(self):
+        return self.cache.stats() if self.cache is not None else None
+
+    @property
+    def loaded(self):
+        return self.artifacts is not None
+
+    @property
+    def preprocessor(self):
+        return self.artifacts[0]
+
+    @property
+    def regressor(self):
+        return self.artifacts[1]
+
+    def load(self, warmup=True):
+        with self._lock:
+            if not self.loaded:
+                self._load(warmup)
+        return self
+
+    def _load(self, warmup):
+        start = time.perf_counter()
+        self.artifact_stamp = artifact_stamp(self.folder_path)
+        self.artifact_hash = artifact_hash(self.folder_path)
+        preprocessor = load_preprocessor(self.folder_path)
+        regressor = load_model(self.folder_path)
+        self.artifacts = (preprocessor, regressor)
+        self.last_reload_check = time.monotonic()
+        self.load_seconds = time.perf_counter() - start
+        if self.use_fast_path:
+            self.build_fast_path()
+        if warmup:
+            self.warmup()
+
+    def reload_if_changed(self):
+        with self._lock:
+            self.last_reload_check = time.monotonic()
+            if self.loaded and artifact_stamp(self.folder_path) != self.artifact_stamp:
+                self._load(warmup=True)
+        return self
+
+    def preload(self, warmup=True):
+        with self._lock:
+            if not self.loaded and self._preload_thread is None:
+                self._preload_thread = threading.Thread(target=self.load, args=(warmup,), daemon=True)
+                self._preload_thread.start()
+        return self
+
+    def enable_fast_path(self):
+        with self._lock:
+            self.use_fast_path = True
+            if self.loaded and self.fast_predictor is None:
+                self.build_fast_path()
+        return self
+
+    def build_fast_path(self):
+        try:
+            self.fast_predictor = FastPredictor(self.preprocessor, self.regressor, load_vocabularies(self.folder_path))
+        except NotSeparableError as error:
+            warnings.warn(f'Fast path disabled: {error}')
+            self.fast_predictor = None
+            self.use_fast_path = False
+        self.live_preview = LivePreview(self.fast_predictor) if self.fast_predictor is not None else None
+
+    def warmup(self):
+        # XGBoost pays a noticeable one-off cost on its first predict call
+        car = default_car(load_vocabularies(self.folder_path))
+        start = time.perf_counter()
+        self._predict(make_frame([car]))
+        if self.fast_predictor is not None:
+            self.fast_predictor.predict_car(car)
+        self.warmup_seconds = time.perf_counter() - start
+
+    def _predict(self, X):
+        preprocessor, regressor = self.artifacts
+        X_prepared = timed_transform(preprocessor, X)
+        with profiler.stage('model.predict'):
+            return regressor.predict(X_prepared)
+
+    def _record_first_predict(self, start):
+        if self.first_predict_seconds is None:
+            self.first_predict_seconds = time.perf_counter() - start
+
+    def predict(self, X):
+        if not self.loaded:
+            self.load()
+        start = time.perf_counter()
+        with profiler.call():
+            prices = self._predict(X)
+        self._record_first_predict(start)
+        return prices
+
+    def predict_car(self, car):
+        if not self.loaded:
+            self.load()
+        elif time.monotonic() - self.last_reload_check > self.reload_check_interval:
+            self.reload_if_changed()
+        with profiler.call(), profiler.stage('predict_car'):
+            if self.cache is None:
+                return self._predict_car(car)
+            return self.cache.get_or_predict(car, self._predict_car, self.artifact_hash)
+
+    def _predict_car(self, car):
+        if self.fast_predictor is None:
+            with profiler.stage('frame'):
+                X = make_frame([car])
+            return float(self.predict(X)[0])
+
+        start = time.perf_counter()
+        # The fast path encodes into a single preallocated row
+        with self._lock:
+            price = self.fast_predictor.predict_car(car)
+        self._record_first_predict(start)
+        return price
+
+    def encode_car(self, car):
+        # The car as a float32 row of the preprocessed columns the model sees
+        if not self.loaded:
+            self.load()
+        if self.fast_predictor is not None:
+            with self._lock:
+                return self.fast_predictor.encoder.encode(car)[0].copy()
+        preprocessor, _ = self.artifacts
+        X_prepared = preprocessor.transform(make_frame([car]))
+        X_prepared = X_prepared.toarray() if scipy.sparse.issparse(X_prepared) else X_prepared
+        return np.asarray(X_prepared, dtype=np.float32)[0]
+
+    def preview_car(self, car):
+        # Like predict_car, but successive calls only re-encode the inputs that changed since the previous one
+        if not self.loaded:
+            self.load()
+        elif time.monotonic() - self.last_reload_check > self.reload_check_interval:
+            self.reload_if_changed()
+        if self.live_preview is None:
+            return self.predict_car(car)
+        with self._lock:
+            return self.live_preview.predict_car(car)
+
+
+_predictors = dict()
+_predictors_lock = threading.Lock()
+
+
+def get_predictor(folder_path=data_path, cache_size=1024, cache_ttl=None):
+    # The cache options apply when the shared predictor of the folder is created, configure_cache changes them later
+    folder_path = Path(folder_path).resolve()
+    with _predictors_lock:
+        if folder_path not in _predictors:
+            _predictors[folder_path] = Predictor(folder_path, cache_size, cache_ttl)
+        return _predictors[folder_path]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure cold-start and first-prediction latency of the model.')
+    parser.add_argument('--data-path', default=data_path, help='folder with preprocessor.pkl and simplified_model.pkl')
+    parser.add_argument('--no-warmup', action='store_true', help='skip the warm-up prediction after loading')
+    parser.add_argument('--fast-path', action='store_true', help='use the low-latency single-row path')
+    parser.add_argument('--cache-size', type=int, default=1024, help='cached estimates (0 disables the cache)')
+    parser.add_argument('--cache-ttl', type=float, default=None, help='seconds an estimate stays cached (no limit)')
+    parser.add_argument('--repeat', type=int, default=2, help='estimates of the same car after loading')
+    args = parser.parse_args(argv)
+
+    predictor = Predictor(args.data_path, args.cache_size, args.cache_ttl)
+    if args.fast_path:
+        predictor.enable_fast_path()
+    predictor.load(warmup=not args.no_warmup)
+    car = default_car(load_vocabularies(args.data_path))
+    for _ in range(args.repeat):
+        predictor.predict_car(car)
+
+    print(f'Model loading: {predictor.load_seconds * 1000:.1f} ms')
+    if predictor.warmup_seconds is not None:
+        print(f'Warm-up prediction: {predictor.warmup_seconds * 1000:.1f} ms')
+    print(f'First prediction: {predictor.first_predict_seconds * 1000:.1f} ms')
+    stats = predictor.cache_stats()
+    if stats is not None:
+        print(f'Prediction cache: {stats["size"]:,} of {stats["max_size"]:,} entries, {stats["hits"]:,} hits, '
+              f'{stats["misses"]:,} misses ({stats["hit_rate"]:.0%} hit rate), {stats["evictions"]:,} evictions, '
+              f'{stats["expirations"]:,} expirations, {stats["invalidations"]:,} invalidations')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+import numpy as np
+
+
+profile_path = Path.cwd() / 'profiles'
+# Bucket edges in milliseconds of the per-stage histograms
+histogram_edges = [0.01, 0.03, 0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000]
+
+
+class LatencyStats:
+
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        self.count = 0
+
+    def record(self, seconds):
+        self.latencies.append(seconds)
+        self.count += 1
+
+    def summary(self):
+        if not self.latencies:
+            return {'count': self.count, 'p50_ms': None, 'p99_ms': None}
+        p50, p99 = np.percentile(np.fromiter(self.latencies, dtype=np.float64), [50, 99]) * 1000
+        return {'count': self.count, 'p50_ms': float(p50), 'p99_ms': float(p99)}
+
+    def histogram(self):
+        # Counts of the latencies in the window per bucket, the last bucket collects everything slower
+        milliseconds = np.fromiter(self.latencies, dtype=np.float64) * 1000
+        counts = np.bincount(np.searchsorted(histogram_edges, milliseconds, side='right'),
+                             minlength=len(histogram_edges) + 1)
+        labels = [f'<{histogram_edges[0]:g}'] + \
+            [f'{low:g}-{high:g}' for low, high in zip(histogram_edges, histogram_edges[1:])] + \
+            [f'>={histogram_edges[-1]:g}']
+        return dict(zip(labels, counts.tolist()))
+
+
+class Profiler:
+
+    def __init__(self, enabled=False, window=10000):
+        self.enabled = enabled
+        self.window = window
+        self.stages = dict()
+        self.cprofile = None
+        self.cprofile_path = None
+        self.cprofile_calls = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+        return self
+
+    def record(self, name, seconds):
+        with self._lock:
+            if name not in self.stages:
+                self.stages[name] = LatencyStats(self.window)
+            self.stages[name].record(seconds)
+
+    @contextmanager
+    def _timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def stage(self, name):
+        # Costs a single attribute check while profiling is off
+        return self._timed(name) if self.enabled else nullcontext()
+
+    @contextmanager
+    def call(self):
+        # Wraps a whole prediction, so a requested cProfile run covers whole calls (nested calls count once)
+        profile = self.cprofile
+        if profile is None or getattr(self._local, 'profiling', False):
+            yield
+            return
+        self._local.profiling = True
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._local.profiling = False
+            self.cprofile_calls -= 1
+            if self.cprofile_calls <= 0:
+                self.dump_cprofile()
+
+    def profile_calls(self, calls, path=None):
+        path = Path(path) if path else profile_path / f'predict-{time.strftime("%Y%m%d-%H%M%S")}.prof'
+        self.cprofile, self.cprofile_path, self.cprofile_calls = cProfile.Profile(), path, calls
+        return path
+
+    def dump_cprofile(self):
+        profile, self.cprofile = self.cprofile, None
+        if profile is not None:
+            self.cprofile_path.parent.mkdir(parents=True, exist_ok=True)
+            profile.dump_stats(self.cprofile_path)
+        return self.cprofile_path
+
+    @staticmethod
+    def start_tracemalloc(frames=10):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    @staticmethod
+    def dump_tracemalloc(path=None, top=10):
+        if not tracemalloc.is_tracing():
+            return None, []
+        path = Path(path) if path else profile_path / f'memory-{time.strftime("%Y%m%d-%H%M%S")}.tracemalloc'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        snapshot = tracemalloc.take_snapshot()
+        snapshot.dump(str(path))
+        return path, [str(stat) for stat in snapshot.statistics('lineno')[:top]]
+
+    def stats(self):
+        with self._lock:
+            return {name: {**stats.summary(), 'histogram_ms': stats.histogram()}
+                    for name, stats in self.stages.items()}
+
+    def export(self, path=None):
+        path = Path(path) if path else profile_path / f'stages-{time.strftime("%Y%m%d-%H%M%S")}.json'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps({'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'stages': self.stats()}, indent=2))
+        return path
+
+    def reset(self):
+        with self._lock:
+            self.stages.clear()
+
+
+profiler = Profiler(enabled=os.environ.get('CAR_MARKET_PROFILE', '') not in ('', '0'))
+
+
+def timed_transform(preprocessor, X):
+    # Runs the pipeline step by step to time each kind of transformer (e.g. all CarsTransformers together)
+    if not profiler.enabled or not hasattr(preprocessor, 'steps'):
+        return preprocessor.transform(X)
+    timings = dict()
+    for _, step in preprocessor.steps:
+        if step is None or step == 'passthrough':
+            continue
+        start = time.perf_counter()
+        X = timed_transform(step, X) if hasattr(step, 'steps') else step.transform(X)
+        if not hasattr(step, 'steps'):
+            name = f'transform.{type(step).__name__}'
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+    for name, seconds in timings.items():
+        profiler.record(name, seconds)
+    return X
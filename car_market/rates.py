@@ -0,0 +1,114 @@
+import argparse
+import datetime
+import functools
+import json
+import time
+from pathlib import Path
+import numpy as np
+from car_market.artifacts import data_path
+
+
+rates_path = data_path / 'exchange_rates.json'
+snapshot_currencies = ['EUR', 'PLN', 'USD']
+snapshot_since = datetime.date(2019, 1, 1)
+
+
+class ExchangeRates:
+
+    def __init__(self, first_date, rates, updated=None):
+        # EUR-based rates (as published by the ECB) for consecutive days, missing days filled in by the converter
+        self.first_date = first_date
+        self.rates = {currency: np.asarray(values, dtype=np.float64) for currency, values in rates.items()}
+        self.updated = updated
+        self.days = len(next(iter(self.rates.values())))
+        self.last_date = first_date + datetime.timedelta(days=self.days - 1)
+
+    def day_index(self, date):
+        # Dates outside the snapshot fall back to its first or last day
+        if date is None:
+            return self.days - 1
+        return min(max(date.toordinal() - self.first_date.toordinal(), 0), self.days - 1)
+
+    def currency_rates(self, currency):
+        rates = self.rates.get(currency)
+        if rates is None:
+            raise ValueError(f'{currency} is not in the exchange rate snapshot')
+        return rates
+
+    def rate(self, currency, new_currency='EUR', date=None):
+        i = self.day_index(date)
+        return float(self.currency_rates(new_currency)[i] / self.currency_rates(currency)[i])
+
+    def convert(self, amount, currency, new_currency='EUR', date=None):
+        return amount * self.rate(currency, new_currency, date)
+
+    def rates_for(self, currencies, dates, new_currency='EUR'):
+        # One rate per row, looked up by array indexing instead of a call per advert
+        dates = np.asarray(dates, dtype='datetime64[D]')
+        days = (dates - np.datetime64(self.first_date, 'D')).astype(np.int64).clip(0, self.days - 1)
+        days[np.isnat(dates)] = self.days - 1
+        currencies = np.asarray(currencies, dtype=object)
+        result = np.empty(len(days), dtype=np.float64)
+        new_rates = self.currency_rates(new_currency)
+        for currency in set(currencies.tolist()):
+            rows = currencies == currency
+            result[rows] = new_rates[days[rows]] / self.currency_rates(currency)[days[rows]]
+        return result
+
+    def to_json(self):
+        return {'base': 'EUR', 'updated': self.updated, 'first_date': self.first_date.isoformat(),
+                'rates': {currency: np.round(rates, 6).tolist() for currency, rates in self.rates.items()}}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(datetime.date.fromisoformat(data['first_date']), data['rates'], data.get('updated'))
+
+    @classmethod
+    def from_converter(cls, converter, currencies=snapshot_currencies, since=snapshot_since):
+        bounds = [converter.bounds[currency] for currency in currencies if currency != 'EUR']
+        first_date = max([since] + [bound.first_date for bound in bounds])
+        last_date = min(bound.last_date for bound in bounds)
+        dates = [first_date + datetime.timedelta(days=i) for i in range((last_date - first_date).days + 1)]
+        rates = {currency: [converter.convert(1, 'EUR', currency, date=date) for date in dates]
+                 for currency in currencies}
+        return cls(first_date, rates, time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+
+def make_converter(download=False):
+    from currency_converter import CurrencyConverter, ECB_URL
+    if download:
+        return CurrencyConverter(ECB_URL, fallback_on_missing_rate=True)
+    return CurrencyConverter(fallback_on_missing_rate=True)
+
+
+def build_rates(output_path=rates_path, since=snapshot_since, download=False):
+    rates = ExchangeRates.from_converter(make_converter(download), since=since)
+    Path(output_path).write_text(json.dumps(rates.to_json(), separators=(',', ':')), encoding='utf-8')
+    return rates
+
+
+@functools.lru_cache(maxsize=4)
+def load_exchange_rates(path=rates_path):
+    path = Path(path)
+    if path.exists():
+        return ExchangeRates.from_json(json.loads(path.read_text(encoding='utf-8')))
+    # Without a snapshot the full ECB history bundled with currency_converter is parsed
+    return ExchangeRates.from_converter(make_converter())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Refresh the exchange rate snapshot used by the apps.')
+    parser.add_argument('--output', default=rates_path, help='snapshot file to write')
+    parser.add_argument('--since', type=datetime.date.fromisoformat, default=snapshot_since,
+                        help='first day of the snapshot (YYYY-MM-DD)')
+    parser.add_argument('--download', action='store_true',
+                        help='use the latest ECB rates instead of the ones bundled with currency_converter')
+    args = parser.parse_args(argv)
+
+    rates = build_rates(args.output, args.since, args.download)
+    print(f'Exchange rates from {rates.first_date} to {rates.last_date} written to {args.output} '
+          f'({Path(args.output).stat().st_size / 1024:,.0f} KiB)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import ast
+import numpy as np
+import pandas as pd
+from car_market.transformers import CarFeaturesTransformer
+
+
+INPUT_COLUMNS = ['Condition', 'Vehicle_brand', 'Vehicle_model', 'Production_year', 'Mileage_km', 'Power_HP',
+                 'Displacement_cm3', 'Fuel_type', 'Drive', 'Transmission', 'Type', 'Doors_number', 'Colour',
+                 'Offer_location', 'Features']
+NUMERIC_COLUMNS = ['Production_year', 'Mileage_km', 'Power_HP', 'Displacement_cm3', 'Doors_number']
+CATEGORICAL_COLUMNS = ['Condition', 'Vehicle_brand', 'Vehicle_model', 'Fuel_type', 'Drive', 'Transmission', 'Type',
+                       'Colour', 'Offer_location']
+
+
+def parse_features(value):
+    if isinstance(value, str):
+        return list(ast.literal_eval(value)) if value.startswith('[') else [value]
+    if value is None or isinstance(value, float):
+        return []
+    return list(value)
+
+
+def vocabulary_categories(vocabularies, col):
+    if col == 'Vehicle_model':
+        return list(dict.fromkeys(model for models in vocabularies[col].values() for model in models))
+    return list(dict.fromkeys(vocabularies[col]))
+
+
+def to_categorical(column, categories):
+    # Values outside the vocabulary are appended, so the transformers still map them to 'Other'
+    values = column.dropna().unique()
+    extra = pd.Index(values, dtype=object).difference(pd.Index(categories, dtype=object), sort=False)
+    return pd.Categorical(column, categories=list(categories) + extra.tolist())
+
+
+def features_transformer(preprocessor):
+    return next(step for _, step in preprocessor.steps if isinstance(step, CarFeaturesTransformer))
+
+
+def encode_features(features, transformer):
+    # Every distinct list of features is parsed once and packed into a bitset with one bit per indicator column of the
+    # fitted transformer, so the transformer unpacks the bits straight into its columns
+    codes, uniques = pd.factorize(features.map(lambda value: tuple(value) if isinstance(value, list) else value))
+    # Missing values have code -1, which picks the trailing empty list
+    indicators = transformer.indicator_rows([parse_features(value) for value in uniques] + [[]])
+    bitsets = pd.Index([bits.tobytes() for bits in np.packbits(indicators, axis=1)], dtype=object)
+    key_codes, categories = pd.factorize(bitsets[codes])
+    return pd.Categorical.from_codes(key_codes, categories=categories)
+
+
+def prepare_input(data, vocabularies=None, preprocessor=None):
+    missing_columns = [col for col in INPUT_COLUMNS if col not in data.columns]
+    if missing_columns:
+        raise ValueError(f'Missing input columns: {", ".join(missing_columns)}')
+
+    X = data[INPUT_COLUMNS].copy()
+    if vocabularies is not None:
+        # Integer codes with the categories of the vocabularies instead of a Python string per row
+        for col in CATEGORICAL_COLUMNS:
+            X[col] = to_categorical(X[col], vocabulary_categories(vocabularies, col))
+    if preprocessor is None:
+        X['Features'] = X['Features'].map(parse_features)
+    else:
+        # Bitsets of the features the preprocessor was fitted with instead of a Python list per row
+        X['Features'] = encode_features(X['Features'], features_transformer(preprocessor))
+    return X
+
+
+def make_frame(cars):
+    return pd.DataFrame(list(cars), columns=INPUT_COLUMNS)
+
+
+def default_car(vocabularies):
+    brand = vocabularies['Vehicle_brand'][0]
+    return {'Condition': vocabularies['Condition'][0], 'Vehicle_brand': brand,
+            'Vehicle_model': vocabularies['Vehicle_model'][brand][0], 'Production_year': 2010, 'Mileage_km': 100000,
+            'Power_HP': 100, 'Displacement_cm3': 1800, 'Fuel_type': vocabularies['Fuel_type'][0],
+            'Drive': vocabularies['Drive'][0], 'Transmission': vocabularies['Transmission'][0],
+            'Type': vocabularies['Type'][0], 'Doors_number': 4, 'Colour': vocabularies['Colour'][0],
+            'Offer_location': vocabularies['Offer_location'][0], 'Features': []}
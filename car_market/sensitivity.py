@@ -0,0 +1,76 @@
+import argparse
+import time
+import numpy as np
+from car_market.artifacts import data_path, load_vocabularies
+from car_market.fast_path import numeric_domains
+from car_market.predictor import get_predictor
+from car_market.schema import default_car, make_frame
+
+
+def axis_values(field, points=None):
+    # Evenly spaced values from the slider range of the apps
+    values = numeric_domains[field]
+    if points is None or points >= len(values):
+        return list(values)
+    return [values[i] for i in sorted(set(np.linspace(0, len(values) - 1, points).round().astype(int).tolist()))]
+
+
+def grid_cars(car, field, values, field2=None, values2=None):
+    if field2 is None:
+        return [dict(car, **{field: value}) for value in values]
+    return [dict(car, **{field: value, field2: value2}) for value2 in values2 for value in values]
+
+
+def price_curve(predictor, car, field, values=None, points=200):
+    values = axis_values(field, points) if values is None else list(values)
+    start = time.perf_counter()
+    # The whole grid is one DataFrame, one preprocessor pass and one XGBoost call
+    prices = predictor.predict(make_frame(grid_cars(car, field, values)))
+    return {'field': field, 'values': values, 'prices': np.asarray(prices, dtype=np.float64),
+            'seconds': time.perf_counter() - start}
+
+
+def price_heatmap(predictor, car, field, field2, values=None, values2=None, points=60):
+    values = axis_values(field, points) if values is None else list(values)
+    values2 = axis_values(field2, points) if values2 is None else list(values2)
+    start = time.perf_counter()
+    prices = predictor.predict(make_frame(grid_cars(car, field, values, field2, values2)))
+    return {'field': field, 'values': values, 'field2': field2, 'values2': values2,
+            'prices': np.asarray(prices, dtype=np.float64).reshape(len(values2), len(values)),
+            'seconds': time.perf_counter() - start}
+
+
+def curve_figure(result, USD_to_PLN, title=None):
+    return {'data': [{'type': 'scatter', 'mode': 'lines', 'x': result['values'],
+                      'y': (result['prices'] * USD_to_PLN).tolist(), 'hovertemplate': '%{x}: %{y:,.0f} PLN'}],
+            'layout': {'xaxis': {'title': {'text': title or result['field']}},
+                       'yaxis': {'title': {'text': 'Estimated price (PLN)'}}, 'margin': {'t': 30}}}
+
+
+def heatmap_figure(result, USD_to_PLN, title=None, title2=None):
+    return {'data': [{'type': 'heatmap', 'x': result['values'], 'y': result['values2'],
+                      'z': (result['prices'] * USD_to_PLN).tolist(), 'colorbar': {'title': {'text': 'PLN'}}}],
+            'layout': {'xaxis': {'title': {'text': title or result['field']}},
+                       'yaxis': {'title': {'text': title2 or result['field2']}}, 'margin': {'t': 30}}}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time price sensitivity curves computed as one batched prediction.')
+    parser.add_argument('field', choices=list(numeric_domains), help='input varied along the curve')
+    parser.add_argument('--field2', choices=list(numeric_domains), default=None, help='second input for a heatmap')
+    parser.add_argument('--points', type=int, default=None, help='values per input (all slider values by default)')
+    parser.add_argument('--data-path', default=data_path, help='folder with the preprocessor and the model')
+    args = parser.parse_args(argv)
+
+    predictor = get_predictor(args.data_path).load()
+    car = default_car(load_vocabularies(args.data_path))
+    if args.field2 is None:
+        result = price_curve(predictor, car, args.field, points=args.points)
+    else:
+        result = price_heatmap(predictor, car, args.field, args.field2, points=args.points)
+    print(f'{result["prices"].size:,} estimates in {result["seconds"] * 1000:.1f} ms '
+          f'(min {result["prices"].min():,.0f} USD, max {result["prices"].max():,.0f} USD)')
+
+
+if __name__ == '__main__':
+    main()
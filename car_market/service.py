@@ -0,0 +1,234 @@
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+import pandas as pd
+from car_market.artifacts import data_path
+from car_market.predictor import get_predictor
+from car_market.profiling import LatencyStats
+from car_market.rates import load_exchange_rates
+from car_market.schema import NUMERIC_COLUMNS, prepare_input
+
+
+reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+def size_bucket(size):
+    # Power-of-two buckets keep the histogram small for any batch size
+    lower = 1 << (size.bit_length() - 1)
+    return str(lower) if lower == 1 else f'{lower}-{2 * lower - 1}'
+
+
+class MicroBatcher:
+
+    def __init__(self, predict, max_batch_size=256, max_wait=0.005):
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batch_sizes = Counter()
+        self.batches = 0
+        self._queue = None
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.get_running_loop().create_task(self.run())
+        return self
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def submit(self, X):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((X, future))
+        return await future
+
+    async def collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        rows = len(batch[0][0])
+        deadline = loop.time() + self.max_wait
+        # A request with more cars than max_batch_size is still scored as a whole
+        while rows < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch.append(item)
+            rows += len(item[0])
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.collect()
+            X = pd.concat([X for X, _ in batch], ignore_index=True)
+            self.batches += 1
+            self.batch_sizes[size_bucket(len(X))] += 1
+            try:
+                # One predict call for all queued requests, off the event loop so new requests keep queueing
+                prices = await loop.run_in_executor(None, self.predict, X)
+            except Exception as error:
+                if len(batch) == 1:
+                    if not batch[0][1].done():
+                        batch[0][1].set_exception(error)
+                else:
+                    await self.predict_separately(batch)
+                continue
+            start = 0
+            for X_part, future in batch:
+                if not future.done():
+                    future.set_result(prices[start:start + len(X_part)])
+                start += len(X_part)
+
+    async def predict_separately(self, batch):
+        # A failed batch is scored again request by request, so only the request that breaks it gets the error
+        loop = asyncio.get_running_loop()
+        for X, future in batch:
+            try:
+                prices = await loop.run_in_executor(None, self.predict, X)
+            except Exception as error:
+                if not future.done():
+                    future.set_exception(error)
+            else:
+                if not future.done():
+                    future.set_result(prices)
+
+    def stats(self):
+        buckets = sorted(self.batch_sizes.items(), key=lambda item: int(item[0].split('-')[0]))
+        return {'batches': self.batches, 'max_batch_size': self.max_batch_size, 'max_wait_ms': self.max_wait * 1000,
+                'batch_sizes': dict(buckets)}
+
+
+class PredictionService:
+
+    def __init__(self, predictor, max_batch_size=256, max_wait=0.005, USD_to_PLN=None):
+        self.predictor = predictor
+        self.batcher = MicroBatcher(predictor.predict, max_batch_size, max_wait)
+        self.USD_to_PLN = load_exchange_rates().rate('USD', 'PLN') if USD_to_PLN is None else USD_to_PLN
+        self.latency = LatencyStats()
+        self.errors = 0
+        self.server = None
+
+    async def start(self, host='127.0.0.1', port=8000, sock=None):
+        await asyncio.get_running_loop().run_in_executor(None, self.predictor.load)
+        self.batcher.start()
+        if sock is not None:
+            # A socket already listening, e.g. shared by the workers of car_market.launcher
+            self.server = await asyncio.start_server(self.handle_connection, sock=sock)
+        else:
+            self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        await self.batcher.stop()
+
+    async def predict(self, payload):
+        cars = payload if isinstance(payload, list) else [payload]
+        if not cars or not all(isinstance(car, dict) for car in cars):
+            raise ValueError('Expected a car object or a non-empty list of car objects')
+        X = prepare_input(pd.DataFrame(cars))
+        # Checked before queueing, so an invalid car does not fail the batch it would join
+        for col in NUMERIC_COLUMNS:
+            try:
+                X[col] = pd.to_numeric(X[col], errors='raise')
+            except (TypeError, ValueError) as error:
+                raise ValueError(f'Invalid {col}: {error}')
+        price_USD = (await self.batcher.submit(X)).astype(float)
+        prices = [{'price_usd': usd, 'price_pln': usd * self.USD_to_PLN} for usd in price_USD.tolist()]
+        return prices if isinstance(payload, list) else prices[0]
+
+    def metrics(self):
+        return {'latency': self.latency.summary(), 'errors': self.errors, **self.batcher.stats()}
+
+    async def route(self, method, path, body):
+        if path == '/predict':
+            if method != 'POST':
+                return 405, {'error': 'Use POST'}
+            start = time.perf_counter()
+            try:
+                result = await self.predict(json.loads(body))
+            except ValueError as error:
+                # Invalid JSON and missing columns
+                self.errors += 1
+                return 400, {'error': str(error)}
+            self.latency.record(time.perf_counter() - start)
+            return 200, result
+        if path == '/metrics' and method == 'GET':
+            return 200, self.metrics()
+        if path == '/health' and method == 'GET':
+            return 200, {'status': 'ok'}
+        return 404, {'error': f'No route for {method} {path}'}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                try:
+                    status, payload = await self.route(method, path.split('?', 1)[0], body)
+                except Exception as error:
+                    self.errors += 1
+                    status, payload = 500, {'error': str(error)}
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                data = json.dumps(payload).encode()
+                head = f'HTTP/1.1 {status} {reasons[status]}\r\nContent-Type: application/json\r\n' \
+                       f'Content-Length: {len(data)}\r\n' + ('' if keep_alive else 'Connection: close\r\n') + '\r\n'
+                writer.write(head.encode('latin-1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(host='127.0.0.1', port=8000, folder_path=data_path, max_batch_size=256, max_wait=0.005):
+    service = PredictionService(get_predictor(folder_path), max_batch_size, max_wait)
+    server = await service.start(host, port)
+    print(f'Serving price estimates on http://{host}:{port}/predict')
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve price estimates over HTTP with micro-batched predictions.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+    parser.add_argument('--data-path', default=data_path, help='folder with the preprocessor and the model')
+    parser.add_argument('--max-batch-size', type=int, default=256, help='maximum number of cars scored at once')
+    parser.add_argument('--max-wait-ms', type=float, default=5.0,
+                        help='how long the first queued request waits for others to join its batch')
+    args = parser.parse_args(argv)
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.data_path, args.max_batch_size, args.max_wait_ms / 1000))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import repeat
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from sklearn.compose import ColumnTransformer
+from sklearn.impute import SimpleImputer
+from sklearn.metrics import mean_squared_error, r2_score
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+from xgboost.sklearn import XGBRegressor
+from car_market.artifacts import bundle_name, data_path, load_pickle, load_vocabularies
+from car_market.bundle import build_bundle
+from car_market.dataset import Deduplicator, extract_province, parse_feature_string, prices_in_usd, read_adverts
+from car_market.rates import load_exchange_rates
+from car_market.schema import INPUT_COLUMNS
+from car_market.transformers import CarFeaturesTransformer, CarsTransformer
+
+
+cache_path = data_path / 'training_cache'
+raw_columns = INPUT_COLUMNS + ['Price', 'Currency', 'Offer_publication_date']
+categorical_columns = ['Condition', 'Vehicle_brand', 'Vehicle_model', 'Fuel_type', 'Drive', 'Transmission', 'Type',
+                       'Colour', 'Offer_location']
+numeric_columns = ['Production_year', 'Mileage_km', 'Power_HP', 'Displacement_cm3', 'Doors_number']
+# Bumped whenever the layout of the preprocessor changes, so older cached preprocessors are not reused
+preprocessor_version = 2
+
+_provinces = None
+
+
+def init_worker(provinces):
+    global _provinces
+    _provinces = provinces
+
+
+def prepare_chunk(adverts, test_percent):
+    adverts = adverts[adverts['Price'].notna()]
+    # The split follows the row hashes, so it does not depend on the order or the chunking of the input
+    test = pd.util.hash_pandas_object(adverts, index=False).to_numpy() % 100 < test_percent
+    X = adverts[INPUT_COLUMNS].assign(Offer_location=extract_province(adverts['Offer_location'], _provinces),
+                                      Features=adverts['Features'].map(parse_feature_string))
+    y = prices_in_usd(adverts, load_exchange_rates())
+    X_train = X[~test]
+    counts = {col: X_train[col].value_counts() for col in categorical_columns}
+    return X, y, test, counts, CarFeaturesTransformer.distinct_features(X_train['Features'])
+
+
+def read_training_data(input_path, chunk_size=50000, n_jobs=None, test_size=0.2):
+    provinces = list(load_vocabularies()['Offer_location'])
+    deduplicate = Deduplicator()
+    chunks = (deduplicate(chunk) for chunk in read_adverts(input_path, chunk_size, columns=raw_columns))
+    with ProcessPoolExecutor(n_jobs, initializer=init_worker, initargs=(provinces,)) as executor:
+        parts = list(executor.map(prepare_chunk, chunks, repeat(round(test_size * 100))))
+    data_hash = hashlib.sha256(deduplicate.all_hashes().tobytes()).hexdigest()
+    return parts, data_hash
+
+
+def fit_transformers(parts, thresh=10):
+    # Fitting the per-chunk statistics in input order gives the same state as fitting the whole dataset at once
+    cars_transformers = [CarsTransformer(col, thresh) for col in categorical_columns]
+    features_transformer = CarFeaturesTransformer()
+    for _, _, _, counts, features in parts:
+        for transformer in cars_transformers:
+            transformer.fit_counts(counts[transformer.col_name])
+        features_transformer.fit_features(features)
+    return cars_transformers, features_transformer
+
+
+def build_preprocessor(cars_transformers, features_transformer):
+    numeric = Pipeline([('imputer', SimpleImputer(strategy='median')), ('scaler', StandardScaler())])
+    columns = ColumnTransformer([('numeric', numeric, numeric_columns),
+                                 ('categorical', OneHotEncoder(handle_unknown='ignore'), categorical_columns)],
+                                remainder='passthrough', sparse_threshold=0)
+    return Pipeline([(transformer.col_name, transformer) for transformer in cars_transformers] +
+                    [('features', features_transformer), ('columns', columns)])
+
+
+def fit_columns(preprocessor, X):
+    # The other steps were fitted from the chunk statistics already
+    for _, step in preprocessor.steps[:-1]:
+        X = step.transform(X)
+    preprocessor['columns'].fit(X)
+    return preprocessor
+
+
+def transform_chunks(preprocessor, X, chunk_size=50000):
+    # Dense float32 rows, as the apps score them; XGBoost would read the zeros of a sparse matrix as missing values
+    X_prepared = None
+    for start in range(0, len(X), chunk_size):
+        chunk = np.asarray(preprocessor.transform(X.iloc[start:start + chunk_size]), dtype=np.float32)
+        if X_prepared is None:
+            X_prepared = np.empty((len(X), chunk.shape[1]), dtype=np.float32)
+        X_prepared[start:start + len(chunk)] = chunk
+    return X_prepared
+
+
+def preprocessor_key(data_hash, thresh, test_size):
+    config = json.dumps({'data_hash': data_hash, 'thresh': thresh, 'test_size': test_size,
+                         'version': preprocessor_version}, sort_keys=True)
+    return hashlib.sha256(config.encode()).hexdigest()
+
+
+class StageTimer:
+
+    def __init__(self):
+        self.seconds = dict()
+
+    @contextmanager
+    def __call__(self, name):
+        start = time.perf_counter()
+        yield
+        self.seconds[name] = time.perf_counter() - start
+
+
+def train(input_path, output_path=data_path, chunk_size=50000, n_jobs=None, test_size=0.2, thresh=10,
+          model_params=None, cache_folder=cache_path, bundle=False):
+    n_jobs = n_jobs or os.cpu_count()
+    output_path = Path(output_path)
+    timer = StageTimer()
+
+    with timer('read and prepare'):
+        parts, data_hash = read_training_data(input_path, chunk_size, n_jobs, test_size)
+        X = pd.concat([part[0] for part in parts])
+        y = np.concatenate([part[1].to_numpy() for part in parts])
+        test = np.concatenate([part[2] for part in parts])
+
+    key = preprocessor_key(data_hash, thresh, test_size)
+    cached_path = Path(cache_folder) / f'preprocessor-{key[:16]}.pkl' if cache_folder else None
+    cached = cached_path is not None and cached_path.exists()
+    with timer('fit preprocessor'):
+        if cached:
+            preprocessor = load_pickle(cached_path)
+        else:
+            preprocessor = fit_columns(build_preprocessor(*fit_transformers(parts, thresh)), X[~test])
+            if cached_path is not None:
+                cached_path.parent.mkdir(parents=True, exist_ok=True)
+                cached_path.write_bytes(pickle.dumps(preprocessor, protocol=pickle.HIGHEST_PROTOCOL))
+
+    with timer('transform'):
+        X_train = transform_chunks(preprocessor, X[~test], chunk_size)
+        X_test = transform_chunks(preprocessor, X[test], chunk_size)
+
+    with timer('train model'):
+        regressor = XGBRegressor(**{'n_estimators': 500, 'learning_rate': 0.1, 'max_depth': 8, **(model_params or {}),
+                                    'tree_method': 'hist', 'n_jobs': n_jobs})
+        regressor.fit(X_train, y[~test])
+
+    metrics = dict()
+    if test.sum() > 1:
+        with timer('evaluate'):
+            predictions = regressor.predict(X_test)
+            metrics = {'rmse': float(np.sqrt(mean_squared_error(y[test], predictions))),
+                       'r2': float(r2_score(y[test], predictions))}
+
+    with timer('write artifacts'):
+        output_path.mkdir(parents=True, exist_ok=True)
+        (output_path / 'preprocessor.pkl').write_bytes(pickle.dumps(preprocessor))
+        (output_path / 'simplified_model.pkl').write_bytes(pickle.dumps(regressor))
+        # A stale bundle would shadow the new pickles in the apps
+        if bundle or (output_path / bundle_name).exists():
+            build_bundle(output_path)
+
+    report = {'rows': len(X), 'train_rows': int((~test).sum()), 'test_rows': int(test.sum()), **metrics,
+              'data_hash': data_hash, 'preprocessor_cached': cached, 'n_jobs': n_jobs, 'stages': timer.seconds}
+    (output_path / 'training_report.json').write_text(json.dumps(report, indent=2))
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Train the preprocessor and the model used by the apps.')
+    parser.add_argument('input', help='raw advert CSV (Car_sale_ads.csv from the Kaggle dataset)')
+    parser.add_argument('--output', default=data_path, help='folder to write the trained artifacts to')
+    parser.add_argument('--chunk-size', type=int, default=50000, help='number of adverts prepared per worker task')
+    parser.add_argument('--n-jobs', type=int, default=None, help='worker processes and XGBoost threads (all cores)')
+    parser.add_argument('--test-size', type=float, default=0.2, help='fraction of adverts held out for evaluation')
+    parser.add_argument('--thresh', type=int, default=10, help='minimum count of a category kept by CarsTransformer')
+    parser.add_argument('--n-estimators', type=int, default=500, help='number of boosted trees')
+    parser.add_argument('--learning-rate', type=float, default=0.1, help='XGBoost learning rate')
+    parser.add_argument('--max-depth', type=int, default=8, help='maximum tree depth')
+    parser.add_argument('--cache-path', default=cache_path, help='folder with cached fitted preprocessors')
+    parser.add_argument('--no-cache', action='store_true', help='always fit the preprocessor from scratch')
+    parser.add_argument('--bundle', action='store_true', help=f'also write {bundle_name}')
+    args = parser.parse_args(argv)
+
+    report = train(args.input, args.output, args.chunk_size, args.n_jobs, args.test_size, args.thresh,
+                   {'n_estimators': args.n_estimators, 'learning_rate': args.learning_rate,
+                    'max_depth': args.max_depth}, None if args.no_cache else args.cache_path, args.bundle)
+    for name, seconds in report['stages'].items():
+        print(f'{name}: {seconds:.2f} s')
+    print(f'Trained on {report["train_rows"]:,} adverts with {report["n_jobs"]} jobs'
+          + (' (cached preprocessor)' if report['preprocessor_cached'] else ''))
+    if 'rmse' in report:
+        print(f'Test RMSE: {report["rmse"]:,.0f} USD, R2: {report["r2"]:.3f} on {report["test_rows"]:,} adverts')
+
+
+if __name__ == '__main__':
+    main()
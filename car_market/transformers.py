@@ -0,0 +1,133 @@
+from itertools import chain
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator, TransformerMixin
+
+
+class CarsTransformer(BaseEstimator, TransformerMixin):
+
+    def __init__(self, col_name, thresh=10):
+        self.values_dict = dict()
+        self.thresh = thresh
+        self.col_name = col_name
+
+    def fit(self, X):
+        return self.fit_counts(X[self.col_name].value_counts())
+
+    def fit_counts(self, counts):
+        # Counts of separate chunks can be fitted one after another, as fitting the whole column at once
+        for val, count in counts.items():
+            self.values_dict[val] = self.values_dict.get(val, 0) + count
+        self.most_popular_values = frozenset(val for val, count in self.values_dict.items() if count >= self.thresh)
+        return self
+
+    def get_most_popular_values(self):
+        # Instances pickled before the switch to frozenset carry a list
+        if not isinstance(self.most_popular_values, frozenset):
+            self.most_popular_values = frozenset(self.most_popular_values)
+        return self.most_popular_values
+
+    def transform(self, X):
+        column = X[self.col_name]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            return X.assign(**{self.col_name: self.transform_categorical(column)})
+        values = column.where(column.isin(self.get_most_popular_values()), 'Other')
+        values = values.where(column.notna(), 'Unknown')
+        return X.assign(**{self.col_name: values})
+
+    def transform_categorical(self, column):
+        # Only the categories are looked up, the rows just get their codes remapped
+        categories = column.cat.categories
+        mapped = pd.Index(np.where(categories.isin(self.get_most_popular_values()), categories, 'Other'), dtype=object)
+        new_categories = pd.Index(mapped.unique().tolist() + ['Unknown'], dtype=object).unique()
+        codes = column.cat.codes.to_numpy()
+        new_codes = np.where(codes >= 0, new_categories.get_indexer(mapped)[codes], new_categories.get_loc('Unknown'))
+        return pd.Series(pd.Categorical.from_codes(new_codes, new_categories), index=column.index)
+
+
+class CarFeaturesTransformer(BaseEstimator, TransformerMixin):
+
+    def __init__(self):
+        self.features_list = list()
+
+    @staticmethod
+    def normalize_feature(feature):
+        return feature.lower().replace(' ', '_').replace('-', '_')
+
+    @staticmethod
+    def distinct_features(features):
+        # Raw feature names in order of first appearance
+        return list(dict.fromkeys(chain.from_iterable(features)))
+
+    def fit(self, X, col_name='Features'):
+        return self.fit_features(CarFeaturesTransformer.distinct_features(X[col_name]))
+
+    def fit_features(self, features):
+        known_features = set(self.features_list)
+        for feature in features:
+            feature = CarFeaturesTransformer.normalize_feature(feature)
+            if feature not in known_features:
+                known_features.add(feature)
+                self.features_list.append(feature)
+        self.features_index = {feature: i for i, feature in enumerate(self.features_list)}
+        return self
+
+    def get_features_index(self):
+        # Instances pickled before the index was introduced only carry features_list
+        if getattr(self, 'features_index', None) is None or len(self.features_index) != len(self.features_list):
+            self.features_index = {feature: i for i, feature in enumerate(self.features_list)}
+        return self.features_index
+
+    def transform(self, X, col_name='Features'):
+        features = X[col_name]
+        if not isinstance(features.dtype, pd.CategoricalDtype):
+            kinds = {type(value) for value in features}
+            if kinds == {bytes}:
+                # Bitsets of frames joined with pd.concat, which drops categories that differ between the frames
+                features = features.astype('category')
+            elif not kinds <= {list, tuple}:
+                names = ', '.join(sorted(kind.__name__ for kind in kinds - {list, tuple}))
+                raise TypeError(f'{col_name} must hold lists of feature names or bitsets from encode_features, '
+                                f'not {names}')
+
+        if isinstance(features.dtype, pd.CategoricalDtype):
+            # Each distinct bitset is unpacked once and the rows pick theirs by code
+            indicators = self.unpack_bitsets(features.cat.categories)[features.cat.codes.to_numpy()]
+        else:
+            indicators = self.indicator_rows(features)
+
+        X_features = pd.DataFrame(indicators, index=X.index, columns=self.features_list)
+        return pd.concat([X.drop(columns=[col_name]), X_features], axis=1)
+
+    def unpack_bitsets(self, bitsets):
+        # Bit i is the indicator column of features_list[i]
+        width = (len(self.features_list) + 7) // 8
+        if not all(isinstance(bits, bytes) and len(bits) == width for bits in bitsets):
+            raise ValueError(f'Features bitsets must be {width} bytes long, encode them with the same preprocessor')
+        packed = np.frombuffer(b''.join(bitsets), dtype=np.uint8).reshape(len(bitsets), width)
+
+        # The extra zero row is picked by missing values (code -1)
+        indicators = np.zeros((len(bitsets) + 1, len(self.features_list)), dtype=np.uint8)
+        indicators[:-1] = np.unpackbits(packed, axis=1, count=len(self.features_list))
+        return indicators
+
+    def indicator_rows(self, features):
+        features_index = self.get_features_index()
+        raw_index = dict()
+
+        def feature_position(feature):
+            position = raw_index.get(feature)
+            if position is None:
+                position = features_index.get(CarFeaturesTransformer.normalize_feature(feature), -1)
+                raw_index[feature] = position
+            return position
+
+        counts = np.fromiter((len(row_features) for row_features in features), dtype=np.int64, count=len(features))
+        positions = np.fromiter((feature_position(feature) for row_features in features for feature in row_features),
+                                dtype=np.int64, count=counts.sum())
+        rows = np.repeat(np.arange(len(features)), counts)
+        known = positions >= 0
+
+        indicators = np.zeros((len(features), len(self.features_list)), dtype=np.uint8)
+        indicators[rows[known], positions[known]] = 1
+        return indicators
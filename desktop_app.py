@@ -1,71 +1,19 @@
-import os
 import sys
-import pickle
-import pandas as pd
 import numpy as np
-from sklearn.base import BaseEstimator, TransformerMixin
-from currency_converter import CurrencyConverter
-from PyQt6.QtWidgets import QApplication, QWidget, QComboBox, QVBoxLayout, QHBoxLayout, QLabel, QSlider, QPushButton
-from PyQt6.QtGui import QFont
-from PyQt6.QtCore import Qt
-
-
-class CarsTransformer(BaseEstimator, TransformerMixin):
-
-    def __init__(self, col_name, thresh=10):
-        self.values_dict = dict()
-        self.thresh = thresh
-        self.col_name = col_name
-
-    def fit(self, X):
-        for _, val in X[self.col_name].iteritems():
-            if not val in self.values_dict.keys():
-                self.values_dict[val] = 1
-            else:
-                self.values_dict[val] += 1
-        self.most_popular_values = [val for val, count in self.values_dict.items() if count >= self.thresh]
-        return self
-
-    @staticmethod
-    def check_value(value, most_popular_values):
-        if pd.isna(value):
-            return 'Unknown'
-        else:
-            return value if value in most_popular_values else 'Other'
-
-    def transform(self, X):
-        X[self.col_name] = X[self.col_name].apply(CarsTransformer.check_value,
-                                                  args=(self.most_popular_values,))
-        return X
-
-
-class CarFeaturesTransformer(BaseEstimator, TransformerMixin):
-
-    def __init__(self):
-        self.features_list = list()
-
-    def fit(self, X, col_name='Features'):
-        for _, features in X[col_name].iteritems():
-            for feature in features:
-                feature = feature.lower().replace(' ', '_').replace('-', '_')
-                if not feature in self.features_list:
-                    self.features_list.append(feature)
-        return self
-
-    @staticmethod
-    def check_feature(x, new_feature):
-        sample_features = [feature.lower().replace(' ', '_').replace('-', '_') for feature in x]
-        return 1 if new_feature in sample_features else 0
-
-    def transform(self, X, col_name='Features'):
-        X_new = X.copy()
-        for new_feature in self.features_list:
-            X_new[new_feature] = X_new[col_name].apply(CarFeaturesTransformer.check_feature,
-                                                       args=(new_feature,))
-        return X_new.drop(columns=[col_name])
+from PyQt6.QtWidgets import QApplication, QWidget, QComboBox, QVBoxLayout, QHBoxLayout, QLabel, QSlider, QPushButton, \
+    QCheckBox, QTableWidget, QTableWidgetItem
+from PyQt6.QtGui import QFont, QKeySequence, QShortcut
+from PyQt6.QtCore import Qt, QObject, QRunnable, QThreadPool, QTimer, pyqtSignal
+from car_market.artifacts import data_path, load_vocabularies
+from car_market.comparables import load_comparables
+from car_market.predictor import get_predictor
+from car_market.profiling import profiler
+from car_market.rates import load_exchange_rates
 
 
 class MultiComboBox(QComboBox):
+    checkedChanged = pyqtSignal()
+
     def __init__(self):
         super().__init__()
         self._changed = False
@@ -87,6 +35,7 @@ class MultiComboBox(QComboBox):
         else:
             item.setCheckState(Qt.CheckState.Checked)
         self._changed = True
+        self.checkedChanged.emit()
 
     def hidePopup(self):
         if not self._changed:
@@ -98,6 +47,29 @@ class MultiComboBox(QComboBox):
         return item.checkState() == Qt.CheckState.Checked
 
 
+class WorkerSignals(QObject):
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+
+class Worker(QRunnable):
+
+    def __init__(self, function, *args):
+        super().__init__()
+        self.function = function
+        self.args = args
+        self.signals = WorkerSignals()
+
+    def run(self):
+        # The signals are delivered to the GUI thread, which owns the connected window
+        try:
+            result = self.function(*self.args)
+        except Exception as error:
+            self.signals.failed.emit(str(error))
+        else:
+            self.signals.finished.emit(result)
+
+
 class MyWindow(QWidget):
 
     def __init__(self):
@@ -108,49 +80,99 @@ class MyWindow(QWidget):
         self.setWindowTitle("Car price estimator")
         self.setFixedWidth(600)
         self.setFixedHeight(750)
-        self.folder_path = '.\\web_app_data'
-        converter = CurrencyConverter(fallback_on_missing_rate=True)
-        self.USD_to_PLN = converter.convert(1, 'USD', 'PLN')
+        self.folder_path = data_path
+        self.USD_to_PLN = load_exchange_rates().rate('USD', 'PLN')
+        self.thread_pool = QThreadPool.globalInstance()
+        self.workers = set()
+        self.predictor = None
+        self.comparables = None
+        self.comparables_table = None
+        self.models = dict()
+        self.request_id = 0
+        self.running_request = None
+        self.pending_request = None
+        # Slider drags emit a burst of changes, the live estimate waits until they pause
+        self.live_timer = QTimer(self)
+        self.live_timer.setSingleShot(True)
+        self.live_timer.setInterval(50)
+        self.live_timer.timeout.connect(self.live_estimate)
 
-        self.load_data()
         self.create_layout()
+        self.create_debug_shortcuts()
+        self.load_data()
 
-    def load_data(self):
-        with open(os.path.join(self.folder_path, 'Colour.pkl'), 'rb') as file:
-            self.colours = pickle.load(file)
-
-        with open(os.path.join(self.folder_path, 'Condition.pkl'), 'rb') as file:
-            self.conditions = pickle.load(file)
-
-        with open(os.path.join(self.folder_path, 'Drive.pkl'), 'rb') as file:
-            self.drives = pickle.load(file)
-
-        with open(os.path.join(self.folder_path, 'Features.pkl'), 'rb') as file:
-            self.features = pickle.load(file)
-
-        with open(os.path.join(self.folder_path, 'Fuel_type.pkl'), 'rb') as file:
-            self.fuel_types = pickle.load(file)
+    def create_debug_shortcuts(self):
+        # Stage timings are recorded when the app is started with CAR_MARKET_PROFILE=1
+        QShortcut(QKeySequence('Ctrl+Shift+P'), self).activated.connect(
+            lambda: self.result_label.setText(f'Stage timings saved to {profiler.export().name}'))
+        QShortcut(QKeySequence('Ctrl+Shift+R'), self).activated.connect(
+            lambda: self.result_label.setText(f'Profiling next 10 estimates to {profiler.profile_calls(10).name}'))
+        QShortcut(QKeySequence('Ctrl+Shift+M'), self).activated.connect(self.dump_memory)
+
+    def dump_memory(self):
+        path, _ = profiler.dump_tracemalloc()
+        if path is None:
+            profiler.start_tracemalloc()
+            self.result_label.setText('Memory tracing started, press again for a snapshot')
+        else:
+            self.result_label.setText(f'Memory snapshot saved to {path.name}')
 
-        with open(os.path.join(self.folder_path, 'Offer_location.pkl'), 'rb') as file:
-            self.offer_locations = pickle.load(file)
+    def start_worker(self, on_finished, function, *args):
+        worker = Worker(function, *args)
+        self.workers.add(worker)
+        worker.signals.finished.connect(lambda result: self.worker_done(worker, on_finished, result))
+        worker.signals.failed.connect(lambda error: self.worker_done(worker, self.worker_failed, error))
+        self.thread_pool.start(worker)
 
-        with open(os.path.join(self.folder_path, 'Transmission.pkl'), 'rb') as file:
-            self.transmissions = pickle.load(file)
+    def worker_done(self, worker, callback, result):
+        self.workers.discard(worker)
+        callback(result)
 
-        with open(os.path.join(self.folder_path, 'Type.pkl'), 'rb') as file:
-            self.body_types = pickle.load(file)
+    def worker_failed(self, error):
+        self.running_request = None
+        self.pending_request = None
+        self.result_label.setText(f'Error: {error}')
 
-        with open(os.path.join(self.folder_path, 'Vehicle_brand.pkl'), 'rb') as file:
-            self.brands = pickle.load(file)
+    def load_data(self):
+        # The window shows up right away, the inputs are filled in once the artifacts are loaded
+        self.result_button.setEnabled(False)
+        self.result_label.setText('Loading model...')
+        self.start_worker(self.data_loaded, self.load_artifacts, self.folder_path)
 
-        with open(os.path.join(self.folder_path, 'Vehicle_model.pkl'), 'rb') as file:
-            self.models = pickle.load(file)
+    @staticmethod
+    def load_artifacts(folder_path):
+        vocabularies = load_vocabularies(folder_path)
+        return vocabularies, get_predictor(folder_path).enable_fast_path().load(), load_comparables(folder_path)
+
+    def data_loaded(self, result):
+        vocabularies, self.predictor, self.comparables = result
+        self.colours = vocabularies['Colour']
+        self.conditions = vocabularies['Condition']
+        self.drives = vocabularies['Drive']
+        self.features = vocabularies['Features']
+        self.fuel_types = vocabularies['Fuel_type']
+        self.offer_locations = vocabularies['Offer_location']
+        self.transmissions = vocabularies['Transmission']
+        self.body_types = vocabularies['Type']
+        self.brands = vocabularies['Vehicle_brand']
+        self.models = vocabularies['Vehicle_model']
 
-        with open(os.path.join(self.folder_path, 'preprocessor.pkl'), 'rb') as file:
-            self.preprocessor = pickle.load(file)
+        self.brand_input.addItems(self.brands)
+        self.condition_input.addItems(self.conditions)
+        self.fuel_type_input.addItems(self.fuel_types)
+        self.transmission_input.addItems(self.transmissions)
+        self.drive_input.addItems(self.drives)
+        self.body_type_input.addItems(self.body_types)
+        self.color_input.addItems(self.colours)
+        self.location_input.addItems(self.offer_locations)
+        for i, feature in enumerate(self.features):
+            self.features_input.addItem(feature)
+            self.features_input.setItemChecked(i, False)
 
-        with open(os.path.join(self.folder_path, 'simplified_model.pkl'), 'rb') as file:
-            self.regressor = pickle.load(file)
+        self.result_button.setEnabled(True)
+        # The index is built separately with python -m car_market.comparables
+        self.comparables_input.setEnabled(self.comparables is not None)
+        self.result_label.setText('')
 
     def create_layout(self):
         layout = QVBoxLayout()
@@ -163,21 +185,17 @@ class MyWindow(QWidget):
         brand_label.setFont(QFont("Sanserif", 6, QFont.Weight.ExtraBold))
 
         self.brand_input = QComboBox()
-        self.brand_input.addItems(self.brands)
         self.brand_input.currentTextChanged.connect(self.brand_input_changed)
 
         model_label = QLabel('MODEL:')
         model_label.setFont(QFont("Sanserif", 6, QFont.Weight.ExtraBold))
 
         self.model_input = QComboBox()
-        self.choosen_brand = self.brand_input.currentText()
-        self.model_input.addItems(self.models[self.choosen_brand])
 
         condition_label = QLabel('CONDITION:')
         condition_label.setFont(QFont("Sanserif", 6, QFont.Weight.ExtraBold))
 
         self.condition_input = QComboBox()
-        self.condition_input.addItems(self.conditions)
 
         production_year_label = QLabel('PRODUCTION YEAR:')
         production_year_label.setFont(QFont("Sanserif", 6, QFont.Weight.ExtraBold))
@@ -225,7 +243,6 @@ class MyWindow(QWidget):
         fuel_type_label.setFont(QFont("Sanserif", 6, QFont.Weight.ExtraBold))
 
         self.fuel_type_input = QComboBox()
-        self.fuel_type_input.addItems(self.fuel_types)
 
         engine_displacement_label = QLabel('ENGINE DISPLACEMENT (LITRES):')
         engine_displacement_label.setFont(QFont("Sanserif", 6, QFont.Weight.ExtraBold))
@@ -273,31 +290,26 @@ class MyWindow(QWidget):
         transmission_label.setFont(QFont("Sanserif", 6, QFont.Weight.ExtraBold))
 
         self.transmission_input = QComboBox()
-        self.transmission_input.addItems(self.transmissions)
 
         drive_label = QLabel('DRIVE:')
         drive_label.setFont(QFont("Sanserif", 6, QFont.Weight.ExtraBold))
 
         self.drive_input = QComboBox()
-        self.drive_input.addItems(self.drives)
 
         body_type_label = QLabel('BODY TYPE:')
         body_type_label.setFont(QFont("Sanserif", 6, QFont.Weight.ExtraBold))
 
         self.body_type_input = QComboBox()
-        self.body_type_input.addItems(self.body_types)
 
         color_label = QLabel('COLOR:')
         color_label.setFont(QFont("Sanserif", 6, QFont.Weight.ExtraBold))
 
         self.color_input = QComboBox()
-        self.color_input.addItems(self.colours)
 
         location_label = QLabel('LOCATION:')
         location_label.setFont(QFont("Sanserif", 6, QFont.Weight.ExtraBold))
 
         self.location_input = QComboBox()
-        self.location_input.addItems(self.offer_locations)
 
         doors_label = QLabel('DOORS NUMBER:')
         doors_label.setFont(QFont("Sanserif", 6, QFont.Weight.ExtraBold))
@@ -324,15 +336,19 @@ class MyWindow(QWidget):
         features_label.setFont(QFont("Sanserif", 6, QFont.Weight.ExtraBold))
 
         self.features_input = MultiComboBox()
-        for i, feature in enumerate(self.features):
-            self.features_input.addItem(feature)
-            self.features_input.setItemChecked(i, False)
 
         self.result_button = QPushButton('ESTIMATE PRICE')
         self.result_button.setFont(QFont("Times", 8, QFont.Weight.ExtraBold))
         self.result_button.setFixedHeight(30)
         self.result_button.clicked.connect(self.estimate_price)
 
+        self.live_input = QCheckBox('LIVE ESTIMATE')
+        self.live_input.setFont(QFont("Sanserif", 6, QFont.Weight.ExtraBold))
+        self.live_input.toggled.connect(self.input_changed)
+        self.comparables_input = QCheckBox('SHOW COMPARABLE ADVERTS')
+        self.comparables_input.setFont(QFont("Sanserif", 6, QFont.Weight.ExtraBold))
+        self.comparables_input.setEnabled(False)
+
         self.result_label = QLabel('')
         self.result_label.setFont(QFont("Sanserif", 14, QFont.Weight.ExtraBold, italic=True))
         self.result_label.setStyleSheet('border: 1px solid black')
@@ -370,11 +386,22 @@ class MyWindow(QWidget):
         layout.addLayout(doors_hbox)
         layout.addWidget(features_label)
         layout.addWidget(self.features_input)
+        layout.addWidget(self.live_input)
+        layout.addWidget(self.comparables_input)
         layout.addWidget(self.result_button)
         layout.addWidget(self.result_label)
 
         self.setLayout(layout)
 
+        for combo_box in [self.brand_input, self.model_input, self.condition_input, self.fuel_type_input,
+                          self.transmission_input, self.drive_input, self.body_type_input, self.color_input,
+                          self.location_input]:
+            combo_box.currentTextChanged.connect(self.input_changed)
+        for slider in [self.production_year_input, self.mileage_input, self.engine_displacement_input, self.power_input,
+                       self.doors_input]:
+            slider.valueChanged.connect(self.input_changed)
+        self.features_input.checkedChanged.connect(self.input_changed)
+
     def brand_input_changed(self):
         self.choosen_brand = self.brand_input.currentText()
         self.model_input.clear()
@@ -400,7 +427,7 @@ class MyWindow(QWidget):
         value = self.doors_input.value()
         self.doors_result.setText(str(value))
 
-    def estimate_price(self):
+    def current_car(self):
         brand = self.brand_input.currentText()
         model = self.model_input.currentText()
         condition = self.condition_input.currentText()
@@ -417,16 +444,72 @@ class MyWindow(QWidget):
         doors = self.doors_input.value()
         features = [self.features[i] for i in range(self.features_input.count()) if self.features_input.itemChecked(i)]
 
-        X = pd.DataFrame({'Condition': [condition], 'Vehicle_brand': [brand], 'Vehicle_model': [model],
-                          'Production_year': [production_year], 'Mileage_km': [mileage], 'Power_HP': [power],
-                          'Displacement_cm3': [engine_displacement], 'Fuel_type': [fuel_type], 'Drive': [drive],
-                          'Transmission': [transmission], 'Type': [body_type], 'Doors_number': [doors],
-                          'Colour': [color], 'Offer_location': [location], 'Features': [features]})
-        X_prepared = self.preprocessor.transform(X)
-        price_USD = self.regressor.predict(X_prepared)[0]
-        price_PLN = self.USD_to_PLN * price_USD
+        return {'Condition': condition, 'Vehicle_brand': brand, 'Vehicle_model': model,
+                'Production_year': production_year, 'Mileage_km': mileage, 'Power_HP': power,
+                'Displacement_cm3': engine_displacement, 'Fuel_type': fuel_type, 'Drive': drive,
+                'Transmission': transmission, 'Type': body_type, 'Doors_number': doors, 'Colour': color,
+                'Offer_location': location, 'Features': features}
+
+    def input_changed(self):
+        if self.live_input.isChecked() and self.predictor is not None:
+            self.live_timer.start()
 
-        self.result_label.setText(f'Estimated price: {price_PLN:,.0f} PLN (${price_USD:,.0f})')
+    def live_estimate(self):
+        # Only the inputs changed since the previous live estimate are encoded again
+        self.request_estimate(self.predictor.preview_car, show_progress=False)
+
+    def estimate_price(self):
+        self.request_estimate(self.estimate_with_comparables if self.comparables_input.isChecked()
+                              else self.predictor.predict_car)
+
+    def estimate_with_comparables(self, car):
+        # Runs in a worker thread, the table is filled in once both are ready. The index is looked up again every time,
+        # as the one loaded at start is dropped once the predictor reloads other artifacts
+        comparables = load_comparables(self.folder_path)
+        listings = comparables.search_car(self.predictor, car) if comparables is not None else None
+        return self.predictor.predict_car(car), listings
+
+    def show_comparables(self, listings):
+        if self.comparables_table is None:
+            self.comparables_table = QTableWidget()
+            self.comparables_table.setWindowTitle('The most similar adverts')
+            self.comparables_table.resize(1100, 360)
+        listings = listings.assign(Price_PLN=(listings['Price_USD'] * self.USD_to_PLN).round()).drop(
+            columns=['Price_USD'])
+        self.comparables_table.setRowCount(len(listings))
+        self.comparables_table.setColumnCount(len(listings.columns))
+        self.comparables_table.setHorizontalHeaderLabels(list(listings.columns))
+        for i, row in enumerate(listings.itertuples(index=False)):
+            for j, value in enumerate(row):
+                self.comparables_table.setItem(i, j, QTableWidgetItem(
+                    f'{value:,.2f}' if isinstance(value, float) else str(value)))
+        self.comparables_table.show()
+
+    def request_estimate(self, predict, show_progress=True):
+        self.request_id += 1
+        if self.running_request is not None:
+            # Repeated requests while an estimate is running coalesce into one request for the latest inputs
+            self.pending_request = (self.request_id, predict, self.current_car(), show_progress)
+            return
+        self.submit_estimate(self.request_id, predict, self.current_car(), show_progress)
+
+    def submit_estimate(self, request_id, predict, car, show_progress=True):
+        self.running_request = request_id
+        if show_progress:
+            self.result_label.setText('Estimating...')
+        self.start_worker(lambda result: self.estimate_finished(request_id, result), predict, car)
+
+    def estimate_finished(self, request_id, result):
+        self.running_request = None
+        if self.pending_request is not None:
+            self.submit_estimate(*self.pending_request)
+            self.pending_request = None
+        elif request_id == self.request_id:
+            price_USD, listings = result if isinstance(result, tuple) else (result, None)
+            price_PLN = self.USD_to_PLN * price_USD
+            self.result_label.setText(f'Estimated price: {price_PLN:,.0f} PLN (${price_USD:,.0f})')
+            if listings is not None:
+                self.show_comparables(listings)
 
 
 if __name__ == '__main__':
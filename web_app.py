@@ -1,258 +1,185 @@
-import pickle
-import pandas as pd
+import time
 import streamlit as st
-import streamlit.components.v1 as components
-from sklearn.base import BaseEstimator, TransformerMixin
-from currency_converter import CurrencyConverter
 from pathlib import Path
-from xgboost.sklearn import XGBRegressor
+from car_market.artifacts import load_vocabularies
+from car_market.aggregates import load_market_figure, load_market_summary
+from car_market.comparables import load_comparables
+from car_market.predictor import get_predictor
+from car_market.profiling import profiler
+from car_market.rates import load_exchange_rates
+from car_market.sensitivity import curve_figure, heatmap_figure, price_curve, price_heatmap
 
 
 folder_path = Path(__file__).parents[0]
+rerun_start = time.perf_counter()
 
 
-class CarsTransformer(BaseEstimator, TransformerMixin):
-
-    def __init__(self, col_name, thresh=10):
-        self.values_dict = dict()
-        self.thresh = thresh
-        self.col_name = col_name
-
-    def fit(self, X):
-        for _, val in X[self.col_name].iteritems():
-            if not val in self.values_dict.keys():
-                self.values_dict[val] = 1
-            else:
-                self.values_dict[val] += 1
-        self.most_popular_values = [val for val, count in self.values_dict.items() if count >= self.thresh]
-        return self
-
-    @staticmethod
-    def check_value(value, most_popular_values):
-        if pd.isna(value):
-            return 'Unknown'
-        else:
-            return value if value in most_popular_values else 'Other'
-
-    def transform(self, X):
-        X[self.col_name] = X[self.col_name].apply(CarsTransformer.check_value,
-                                                  args=(self.most_popular_values,))
-        return X
-
-
-class CarFeaturesTransformer(BaseEstimator, TransformerMixin):
-
-    def __init__(self):
-        self.features_list = list()
-
-    def fit(self, X, col_name='Features'):
-        for _, features in X[col_name].iteritems():
-            for feature in features:
-                feature = feature.lower().replace(' ', '_').replace('-', '_')
-                if not feature in self.features_list:
-                    self.features_list.append(feature)
-        return self
-
-    @staticmethod
-    def check_feature(x, new_feature):
-        sample_features = [feature.lower().replace(' ', '_').replace('-', '_') for feature in x]
-        return 1 if new_feature in sample_features else 0
-
-    def transform(self, X, col_name='Features'):
-        X_new = X.copy()
-        for new_feature in self.features_list:
-            X_new[new_feature] = X_new[col_name].apply(CarFeaturesTransformer.check_feature,
-                                                       args=(new_feature,))
-        return X_new.drop(columns=[col_name])
-
-
-@st.cache(hash_funcs={XGBRegressor: id})
-def load_model():
-    with open(folder_path / 'web_app_data/simplified_model.pkl', 'rb') as file:
-        model = pickle.load(file)
-    return model
-
-
-@st.cache
+# Singletons are returned as they are on every rerun, st.cache would hash the whole value each time to detect mutation.
+# None of them is mutated by the page.
+@st.experimental_singleton
 def get_exchange_rate():
-    converter = CurrencyConverter(fallback_on_missing_rate=True)
-    USD_to_PLN = converter.convert(1, 'USD', 'PLN')
-    return USD_to_PLN
-
-
-@st.cache
-def load_preprocessor():
-    with open(folder_path / 'web_app_data/preprocessor.pkl', 'rb') as file:
-        preprocessor = pickle.load(file)
-    return preprocessor
+    return load_exchange_rates().rate('USD', 'PLN')
 
 
-@st.cache
+@st.experimental_singleton
 def load_cols_info():
-    with open(folder_path / 'web_app_data/Colour.pkl', 'rb') as file:
-        colours = pickle.load(file)
-
-    with open(folder_path / 'web_app_data/Condition.pkl', 'rb') as file:
-        conditions = pickle.load(file)
-
-    with open(folder_path / 'web_app_data/Drive.pkl', 'rb') as file:
-        drives = pickle.load(file)
-
-    with open(folder_path / 'web_app_data/Features.pkl', 'rb') as file:
-        features = pickle.load(file)
-
-    with open(folder_path / 'web_app_data/Fuel_type.pkl', 'rb') as file:
-        fuel_types = pickle.load(file)
-
-    with open(folder_path / 'web_app_data/Offer_location.pkl', 'rb') as file:
-        offer_locations = pickle.load(file)
+    return load_vocabularies(folder_path / 'web_app_data')
 
-    with open(folder_path / 'web_app_data/Transmission.pkl', 'rb') as file:
-        transmissions = pickle.load(file)
 
-    with open(folder_path / 'web_app_data/Type.pkl', 'rb') as file:
-        body_types = pickle.load(file)
+exploration_sections = {'Cars prices distribution': [('car_prices', 500)],
+                        'Production years distribution': [('production_years', 500)],
+                        'The most popular car brands': [('car_brands', 500)],
+                        'The most popular car models': [('car_models', 500)],
+                        'Provinces with the most offers': [('provinces', 500)],
+                        'Cars mileages distribution': [('mileage', 500)],
+                        'Cars engine horsepowers distribution': [('horsepowers', 500)],
+                        'Cars engine displacements distribution': [('displacements', 500)],
+                        'Conditions, transmissions, drives, body types and fuel types': [
+                            ('car_conditions', 450), ('car_transmissions', 450), ('car_drives', 450),
+                            ('car_types', 450), ('car_fuel_types', 450)]}
 
-    with open(folder_path / 'web_app_data/Vehicle_brand.pkl', 'rb') as file:
-        brands = pickle.load(file)
 
-    with open(folder_path / 'web_app_data/Vehicle_model.pkl', 'rb') as file:
-        models = pickle.load(file)
+sensitivity_fields = {'PRODUCTION YEAR': 'Production_year', 'MILEAGE (KM)': 'Mileage_km', 'POWER (HP)': 'Power_HP',
+                      'ENGINE DISPLACEMENT (CM3)': 'Displacement_cm3', 'DOORS NUMBER': 'Doors_number'}
 
-    return colours, conditions, drives, features, fuel_types, offer_locations, transmissions, body_types, brands, models
 
+@st.experimental_singleton(show_spinner=False)
+def load_cached_figure(name):
+    return load_market_figure(name)
 
-@st.cache
-def load_htmls():
-    with open(folder_path / 'visualization/car_prices.html', 'r', encoding='utf-8') as file:
-        prices_HTML = file.read()
 
-    with open(folder_path / 'visualization/production_years.html', 'r', encoding='utf-8') as file:
-        production_years_HTML = file.read()
+@st.experimental_singleton
+def load_summary():
+    return load_market_summary()
 
-    with open(folder_path / 'visualization/car_brands.html', 'r', encoding='utf-8') as file:
-        brands_HTML = file.read()
 
-    with open(folder_path / 'visualization/car_models.html', 'r', encoding='utf-8') as file:
-        models_HTML = file.read()
-
-    with open(folder_path / 'visualization/provinces.html', 'r', encoding='utf-8') as file:
-        provinces_HTML = file.read()
-
-    with open(folder_path / 'visualization/mileage.html', 'r', encoding='utf-8') as file:
-        mileages_HTML = file.read()
-
-    with open(folder_path / 'visualization/horsepowers.html', 'r', encoding='utf-8') as file:
-        horsepowers_HTML = file.read()
-
-    with open(folder_path / 'visualization/displacements.html', 'r', encoding='utf-8') as file:
-        displacements_HTML = file.read()
-
-    with open(folder_path / 'visualization/car_conditions.html', 'r', encoding='utf-8') as file:
-        conditions_HTML = file.read()
-
-    with open(folder_path / 'visualization/car_transmissions.html', 'r', encoding='utf-8') as file:
-        transmissions_HTML = file.read()
-
-    with open(folder_path / 'visualization/car_drives.html', 'r', encoding='utf-8') as file:
-        drives_HTML = file.read()
-
-    with open(folder_path / 'visualization/car_types.html', 'r', encoding='utf-8') as file:
-        types_HTML = file.read()
-
-    with open(folder_path / 'visualization/car_fuel_types.html', 'r', encoding='utf-8') as file:
-        fuel_types_HTML = file.read()
-
-    return prices_HTML, production_years_HTML, brands_HTML, models_HTML, provinces_HTML, mileages_HTML, \
-           horsepowers_HTML, displacements_HTML, conditions_HTML, transmissions_HTML, drives_HTML, types_HTML, \
-           fuel_types_HTML
+def show_figure(figure, height):
+    # plotly.js is served once by Streamlit instead of being embedded in every chart
+    st.plotly_chart({'data': figure['data'], 'layout': dict(figure['layout'], height=height)}, use_container_width=True)
 
 
 def show_prediction_page():
     st.title('Car price estimation')
     st.write("""### Provide some informations to estimate the car price""")
 
-    colours, conditions, drives, features, fuel_types, offer_locations, transmissions, body_types, brands, models = \
-        load_cols_info()
-
-    brand = st.selectbox('BRAND:', brands)
-    model = st.selectbox('MODEL:', models[brand])
-    condition = st.selectbox('CONDITION:', conditions)
-    production_year = st.slider('PRODUCTION YEAR', min_value=1950, max_value=2022, step=1, value=2010)
-    mileage_km = st.slider('MILEAGE (KM)', min_value=0, max_value=1000000, step=500, value=100000)
-    fuel_type = st.selectbox('FUEL TYPE:', fuel_types)
-    displacement_l = st.slider('ENGINE DISPLACEMENT (LITRES)', min_value=0.4, max_value=8.4, step=0.1, value=1.8)
-    displacement_cm3 = displacement_l * 1000
-    power_hp = st.slider('POWER (HP)', min_value=1, max_value=1400, step=1, value=100)
-    transmission = st.selectbox('TRANSMISSION:', transmissions)
-    drive = st.selectbox('DRIVE:', drives)
-    body_type = st.selectbox('BODY TYPE:', body_types)
-    colour = st.selectbox('COLOUR:', colours)
-    offer_location = st.selectbox('LOCATION:', offer_locations)
-    doors_number = st.slider('DOORS NUMBER', min_value=1, max_value=8, step=1, value=4)
-    additional_features = st.multiselect('ADDITIONAL CAR FEATURES', features)
-
-    estimate = st.button('ESTIMATE CAR PRICE')
+    cols_info = load_cols_info()
+    predictor = get_predictor(folder_path / 'web_app_data').enable_fast_path().preload()
+
+    # The models depend on the brand, so only the brand reruns the page when changed; the other inputs are sent
+    # together with the form
+    brand = st.selectbox('BRAND:', cols_info['Vehicle_brand'])
+    with st.form('car'):
+        model = st.selectbox('MODEL:', cols_info['Vehicle_model'][brand])
+        condition = st.selectbox('CONDITION:', cols_info['Condition'])
+        production_year = st.slider('PRODUCTION YEAR', min_value=1950, max_value=2022, step=1, value=2010)
+        mileage_km = st.slider('MILEAGE (KM)', min_value=0, max_value=1000000, step=500, value=100000)
+        fuel_type = st.selectbox('FUEL TYPE:', cols_info['Fuel_type'])
+        displacement_l = st.slider('ENGINE DISPLACEMENT (LITRES)', min_value=0.4, max_value=8.4, step=0.1, value=1.8)
+        displacement_cm3 = displacement_l * 1000
+        power_hp = st.slider('POWER (HP)', min_value=1, max_value=1400, step=1, value=100)
+        transmission = st.selectbox('TRANSMISSION:', cols_info['Transmission'])
+        drive = st.selectbox('DRIVE:', cols_info['Drive'])
+        body_type = st.selectbox('BODY TYPE:', cols_info['Type'])
+        colour = st.selectbox('COLOUR:', cols_info['Colour'])
+        offer_location = st.selectbox('LOCATION:', cols_info['Offer_location'])
+        doors_number = st.slider('DOORS NUMBER', min_value=1, max_value=8, step=1, value=4)
+        additional_features = st.multiselect('ADDITIONAL CAR FEATURES', cols_info['Features'])
+        estimate = st.form_submit_button('ESTIMATE CAR PRICE')
+
+    car = {'Condition': condition, 'Vehicle_brand': brand, 'Vehicle_model': model,
+           'Production_year': production_year, 'Mileage_km': mileage_km, 'Power_HP': power_hp,
+           'Displacement_cm3': displacement_cm3, 'Fuel_type': fuel_type, 'Drive': drive, 'Transmission': transmission,
+           'Type': body_type, 'Doors_number': doors_number, 'Colour': colour, 'Offer_location': offer_location,
+           'Features': additional_features}
+
     if estimate:
-        regressor = load_model()
-        preprocessor = load_preprocessor()
-
-        X = pd.DataFrame({'Condition': [condition], 'Vehicle_brand': [brand], 'Vehicle_model': [model],
-                          'Production_year': [production_year], 'Mileage_km': [mileage_km], 'Power_HP': [power_hp],
-                          'Displacement_cm3': [displacement_cm3], 'Fuel_type': [fuel_type], 'Drive': [drive],
-                          'Transmission': [transmission], 'Type': [body_type], 'Doors_number': [doors_number],
-                          'Colour': [colour], 'Offer_location': [offer_location], 'Features': [additional_features]})
-        X_prepared = preprocessor.transform(X)
-        price_USD = regressor.predict(X_prepared)[0]
+        price_USD = predictor.predict_car(car)
         USD_to_PLN = get_exchange_rate()
         price_PLN = USD_to_PLN * price_USD
 
         st.subheader(f'Estimated price: {price_PLN:,.0f} PLN (${price_USD:,.0f})')
+        show_comparables(predictor, car, USD_to_PLN)
+
+    if st.checkbox('SHOW PRICE SENSITIVITY'):
+        show_sensitivity(predictor, car)
+
+
+def show_comparables(predictor, car, USD_to_PLN):
+    # Shown only when the index was built with python -m car_market.comparables
+    comparables = load_comparables(folder_path / 'web_app_data')
+    if comparables is None:
+        return
+    start = time.perf_counter()
+    listings = comparables.search_car(predictor, car)
+    seconds = time.perf_counter() - start
+    if listings is None:
+        return
+    st.write('##### The most similar adverts')
+    st.dataframe(listings.assign(Price_PLN=(listings['Price_USD'] * USD_to_PLN).round()).drop(columns=['Price_USD']))
+    st.caption(f'Found in {seconds * 1000:.1f} ms')
+
+
+def show_sensitivity(predictor, car):
+    label = st.selectbox('VARY:', list(sensitivity_fields))
+    label2 = st.selectbox('TOGETHER WITH:', ['-'] + [other for other in sensitivity_fields if other != label])
+    if label2 == '-':
+        result = price_curve(predictor, car, sensitivity_fields[label])
+        figure = curve_figure(result, get_exchange_rate(), label)
+    else:
+        result = price_heatmap(predictor, car, sensitivity_fields[label], sensitivity_fields[label2])
+        figure = heatmap_figure(result, get_exchange_rate(), label, label2)
+    show_figure(figure, height=450)
+    st.caption(f'{result["prices"].size:,} estimates computed in one batch in {result["seconds"] * 1000:.0f} ms')
 
 
 def show_exploration_page():
-    prices_HTML, production_years_HTML, brands_HTML, models_HTML, provinces_HTML, mileages_HTML, horsepowers_HTML, \
-    displacements_HTML, conditions_HTML, transmissions_HTML, drives_HTML, types_HTML, fuel_types_HTML = load_htmls()
-
+    summary = load_summary()
     st.title('Polish car market insight')
-    st.write('(Based on 208,304 adverts posted from 2021-03-26 to 2021-05-05 '
+    st.write(f'(Based on {summary["adverts"]:,} adverts posted from {summary["first_date"]} to {summary["last_date"]} '
              'on the popular polish car advertising website)')
 
-    st.subheader('Cars prices distribution')
-    components.html(prices_HTML, height=500)
-
-    st.subheader('Production years distribution')
-    components.html(production_years_HTML, height=500)
-
-    st.subheader('The most popular car brands')
-    components.html(brands_HTML, height=500)
-
-    st.subheader('The most popular car models')
-    components.html(models_HTML, height=500)
-
-    st.subheader('Provinces with the most offers')
-    components.html(provinces_HTML, height=500)
-
-    st.subheader('Cars mileages distribution')
-    components.html(mileages_HTML, height=500)
-
-    st.subheader('Cars engine horsepowers distribution')
-    components.html(horsepowers_HTML, height=500)
-
-    st.subheader('Cars engine displacements distribution')
-    components.html(displacements_HTML, height=500)
-
-    components.html(conditions_HTML, height=450)
-    components.html(transmissions_HTML, height=450)
-    components.html(drives_HTML, height=450)
-    components.html(types_HTML, height=450)
-    components.html(fuel_types_HTML, height=450)
+    section = st.selectbox('CHART:', list(exploration_sections))
+    st.subheader(section)
+    for name, height in exploration_sections[section]:
+        show_figure(load_cached_figure(name), height=height)
+
+
+def show_debug_panel():
+    # Opened with ?debug=1 in the address
+    with st.sidebar.expander('Debug'):
+        profiler.enable(st.checkbox('Record stage timings', value=profiler.enabled))
+        stats = profiler.stats()
+        if stats:
+            st.table([{'stage': name, 'calls': stage['count'], 'p50 ms': stage['p50_ms'], 'p99 ms': stage['p99_ms']}
+                      for name, stage in stats.items()])
+        cache = get_predictor(folder_path / 'web_app_data').cache_stats()
+        if cache is not None:
+            st.table([{'cached': f'{cache["size"]:,} of {cache["max_size"]:,}', 'hits': cache['hits'],
+                       'misses': cache['misses'], 'hit rate': f'{cache["hit_rate"]:.0%}',
+                       'evictions': cache['evictions'], 'expirations': cache['expirations'],
+                       'invalidations': cache['invalidations']}])
+        if st.button('Export stage timings'):
+            st.write(f'Saved to {profiler.export()}')
+        calls = st.number_input('Predictions to profile', min_value=1, max_value=1000, value=10)
+        if st.button('Start cProfile'):
+            st.write(f'The profile will be saved to {profiler.profile_calls(calls)}')
+        if st.button('Start tracemalloc'):
+            profiler.start_tracemalloc()
+        if st.button('Dump tracemalloc snapshot'):
+            path, top = profiler.dump_tracemalloc()
+            st.write(f'Saved to {path}' if path else 'tracemalloc is not running')
+            st.code('\n'.join(top))
 
 
 st.sidebar.write("""# What would you like to do?""")
 page = st.sidebar.selectbox('Predict car price or explore car market in Poland', ('Predict', 'Explore'))
+if st.experimental_get_query_params().get('debug') == ['1']:
+    show_debug_panel()
 
 if page == 'Predict':
     show_prediction_page()
 else:
     show_exploration_page()
+
+if profiler.enabled:
+    profiler.record('web_app.rerun', time.perf_counter() - rerun_start)